@@ -0,0 +1,261 @@
+"""Builds the city without a window, flies the camera around it and records
+   construction time, scene and Bullet counts, peak memory and frame times.
+
+    python benchmark.py --scales 1 2 4
+    python benchmark.py --areas --set FLATTEN="'area'" --set LOD_DISTANCES="(150, 400)"
+
+Each run is made in its own process and appended to benchmark_results.jsonl
+with the current commit, then compared with the latest run of the same settings
+made at another commit.
+"""
+import argparse
+import ast
+import datetime
+import json
+import math
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+    return commit, dirty
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def percentiles(values):
+    values = np.array(values) * 1000
+    return dict(
+        mean_ms=float(values.mean()),
+        p50_ms=float(np.percentile(values, 50)),
+        p95_ms=float(np.percentile(values, 95)),
+        p99_ms=float(np.percentile(values, 99)),
+        max_ms=float(values.max())
+    )
+
+
+def fly_through(app, size, frames, warmup):
+    """Circles the camera over the city, looking at the ground in front of it,
+       and returns the time of each frame after the warmup frames.
+    """
+    app.camera.reparent_to(app.render)
+    radius = size * 0.35
+    height = 40 + size * 0.1
+    times = []
+
+    for i in range(warmup + frames):
+        angle = 2 * math.pi * i / frames
+        app.camera.set_pos(math.cos(angle) * radius, math.sin(angle) * radius, height)
+        ahead = angle + 0.5
+        app.camera.look_at(math.cos(ahead) * radius * 0.5, math.sin(ahead) * radius * 0.5, 0)
+
+        start = time.perf_counter()
+        app.taskMgr.step()
+
+        if i >= warmup:
+            times.append(time.perf_counter() - start)
+
+    return times
+
+
+def run_single(args):
+    from panda3d.core import load_prc_file_data
+    load_prc_file_data('', f"""
+        window-type offscreen
+        load-display {args.display}
+        win-size {args.width} {args.height}
+        sync-video false
+        audio-library-name null""")
+
+    import voronoi_city
+    from panda3d.core import SceneGraphAnalyzer
+    from profiling import profiler
+
+    if not args.areas:
+        voronoi_city.PROCEDURAL_CITY = dict(
+            cells_x=round(args.cells * args.scale), cells_y=round(args.cells * args.scale), seed=args.seed)
+
+    voronoi_city.SEED = args.seed
+    # times rendering and every piece too
+    profiler.enabled = True
+    for name, value in args.settings.items():
+        setattr(voronoi_city, name, value)
+
+    start = time.perf_counter()
+    app = voronoi_city.VoronoiCity()
+    startup = time.perf_counter() - start
+
+    totals = profiler.build_totals()
+    _, create_city = totals['startup']['create_city']
+    count, assemble = totals.get('piece', {}).get('assemble', (0, 0))
+
+    generator = app.scene.generator
+    size = 256 if generator is None else max(generator.width, generator.depth)
+    times = fly_through(app, size, args.frames, args.warmup)
+
+    analyzer = SceneGraphAnalyzer()
+    analyzer.add_node(app.render.node())
+    bodies = app.world.get_rigid_bodies()
+
+    result = dict(
+        startup_s=startup,
+        create_city_s=create_city,
+        assemble=dict(count=count, seconds=assemble),
+        areas={name: seconds for name, (_, seconds) in totals.get('area', {}).items()},
+        scene=dict(
+            nodes=analyzer.get_num_nodes(),
+            geom_nodes=analyzer.get_num_geom_nodes(),
+            geoms=analyzer.get_num_geoms(),
+            vertices=analyzer.get_num_vertices(),
+            triangles=analyzer.get_num_tris(),
+            vertex_data_mb=analyzer.get_vertex_data_size() / (1024 * 1024),
+            # the vertex data of the buildings before and after COMPACT_VERTICES
+            compacted_mb=[size / (1024 * 1024) for size in app.scene.compacted]
+        ),
+        bullet=dict(
+            bodies=len(bodies),
+            shapes=sum(body.get_num_shapes() for body in bodies)
+        ),
+        peak_rss_mb=peak_rss_mb(),
+        frames=dict(count=len(times), **percentiles(times)),
+        render={name: dict(mean_ms=mean, p95_ms=p95, max_ms=peak)
+                for name, (mean, p95, peak) in profiler.frame_stats().items()}
+    )
+    print(RESULT_PREFIX + json.dumps(result))
+
+
+def load_results(path):
+    try:
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def compare(record, previous):
+    """Prints the changes of the main numbers from the previous record."""
+    rows = [
+        ('create_city_s', lambda r: r['create_city_s']),
+        ('frame p50 ms', lambda r: r['frames']['p50_ms']),
+        ('frame p95 ms', lambda r: r['frames']['p95_ms']),
+        ('vertices', lambda r: r['scene']['vertices']),
+        ('geoms', lambda r: r['scene']['geoms']),
+        ('bullet shapes', lambda r: r['bullet']['shapes']),
+        ('peak rss mb', lambda r: r['peak_rss_mb']),
+    ]
+    print(f"  compared with {previous['commit'][:10]} ({previous['time']})")
+
+    for name, get in rows:
+        before, after = get(previous), get(record)
+        if before is None or after is None:
+            continue
+        change = f'{(after - before) / before * 100:+.1f}%' if before else ''
+        print(f'  {name:<14} {before:>12.3f} -> {after:>12.3f} {change}')
+
+
+def parse_setting(text):
+    name, value = text.split('=', 1)
+    return name, ast.literal_eval(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=float, nargs='+', default=[1],
+                        help='multipliers of the number of cells on each side of the procedural city')
+    parser.add_argument('--cells', type=int, default=8, help='cells on each side at scale 1')
+    parser.add_argument('--areas', action='store_true', help='build the hand-authored areas instead')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--display', default='p3tinydisplay',
+                        help='p3tinydisplay renders in software; pandagl uses the GL driver, e.g. Mesa llvmpipe')
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--set', dest='settings', type=parse_setting, action='append', default=[],
+                        metavar='NAME=VALUE', help='overrides a setting of voronoi_city.py')
+    parser.add_argument('--output', default='benchmark_results.jsonl')
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--scale', type=float, default=1, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.settings = dict(args.settings)
+
+    if args.single:
+        run_single(args)
+        return
+
+    commit, dirty = git_commit()
+    results = load_results(args.output)
+    scales = [1] if args.areas else args.scales
+
+    for scale in scales:
+        cmd = [sys.executable, __file__, '--single', '--scale', str(scale)] + sys.argv[1:]
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        lines = [line for line in proc.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+
+        if proc.returncode or not lines:
+            print(proc.stdout[-2000:], proc.stderr[-2000:], sep='\n')
+            sys.exit(f'benchmark at scale {scale} failed')
+
+        config = dict(
+            city='areas' if args.areas else 'procedural',
+            scale=scale,
+            cells=args.cells,
+            seed=args.seed,
+            frames=args.frames,
+            display=args.display,
+            win_size=[args.width, args.height],
+            settings={name: repr(value) for name, value in sorted(args.settings.items())}
+        )
+        record = dict(
+            commit=commit,
+            dirty=dirty,
+            time=datetime.datetime.now().isoformat(timespec='seconds'),
+            python=platform.python_version(),
+            platform=platform.platform(),
+            config=config,
+            **json.loads(lines[-1][len(RESULT_PREFIX):])
+        )
+
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+        print(f"{config['city']} x{scale}: create_city {record['create_city_s']:.3f} s, "
+              f"frame p50 {record['frames']['p50_ms']:.2f} ms, p95 {record['frames']['p95_ms']:.2f} ms, "
+              f"{record['scene']['vertices']} vertices, {record['bullet']['shapes']} shapes")
+
+        previous = [r for r in results if r['config'] == config and r['commit'] != commit]
+        if previous:
+            compare(record, previous[-1])
+
+
+if __name__ == '__main__':
+    main()
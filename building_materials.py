@@ -1,3 +1,9 @@
+import math
+
+import numpy as np
+from panda3d.core import NodePath
+
+from geom_utils import extrude, make_geom_node
 from shapes.src import Cylinder
 from shapes.src import EllipticalPrism
 from shapes.src import Capsule
@@ -7,54 +13,218 @@ from shapes.src import Sphere
 from shapes.src import Torus
 
 
-class MaterialCylinder(Cylinder):
+class TessellationPolicy:
+    """Chooses the segment counts of the materials.
+        Args:
+            edge_length (float): target length of the subdivisions of straight walls and caps.
+            max_angle (float): largest angle in degrees that a segment of a circumference spans;
+                               if None, the segment count passed to the material is used.
+            quality (str): 'low', 'medium' or 'high'; scales all the segment counts.
+    """
+
+    qualities = dict(low=0.5, medium=1., high=2.)
+
+    def __init__(self, edge_length=2., max_angle=None, quality='medium'):
+        if quality not in self.qualities:
+            raise ValueError(f'Unknown quality: {quality}')
+
+        self.edge_length = edge_length
+        self.max_angle = max_angle
+        self.quality = quality
+        self.scale = self.qualities[quality]
+
+    @classmethod
+    def from_screen(cls, pixels, distance, fov=40, screen_height=768, **kwargs):
+        """Makes a policy whose edges are about `pixels` long on the screen
+           when seen from `distance` with a vertical field of view of `fov` degrees.
+        """
+        view_height = 2 * distance * math.tan(math.radians(fov) / 2)
+        return cls(edge_length=pixels * view_height / screen_height, **kwargs)
+
+    def linear(self, length):
+        """Segments along a straight wall; walls shorter than 1.5 edges are not divided."""
+        if length < self.edge_length * 1.5:
+            return 1
+        return max(1, int(length / self.edge_length * self.scale))
+
+    def cap(self, length):
+        """Rings of a cap whose radius is `length`; 0 means a simple fan."""
+        return int(length / self.edge_length * self.scale)
+
+    def circular(self, segs):
+        """Segments around a full circumference; a few segments mean a faceted shape
+           like a square prism, which is kept as it is.
+        """
+        if segs <= 8:
+            return segs
+        if self.max_angle:
+            segs = math.ceil(360 / self.max_angle)
+        return max(8, round(segs * self.scale))
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.edge_length!r}, {self.max_angle!r}, {self.quality!r})'
+
+
+# replace it to change the tessellation of all the materials created afterwards.
+default_policy = TessellationPolicy()
+
+
+# set it to True to generate the geometry of the materials created afterwards with NumPy
+# wherever they support it; each material can also choose by its `vectorized` argument.
+default_vectorized = False
+
+
+def get_policy(policy):
+    return default_policy if policy is None else policy
+
+
+def circle_outline(radius_x, radius_y, segs):
+    angles = np.linspace(0, 2 * np.pi, segs + 1)
+    cos, sin = np.cos(angles), np.sin(angles)
+    normals = np.stack([radius_y * cos, radius_x * sin], axis=-1)
+    normals /= np.linalg.norm(normals, axis=-1, keepdims=True)
+    return np.stack([radius_x * cos, radius_y * sin], axis=-1), normals
+
+
+class Material:
+    """Records the parameters passed to the shapes maker as `key`,
+       so that makers built with the same parameters can share geometry.
+       If `vectorized` is True and the material is a prism that extrude() can make,
+       its geometry is generated with NumPy instead of the shapes maker,
+       which is also recorded in the key.
+    """
+
+    def __init__(self, vectorized=None, **kwargs):
+        super().__init__(**kwargs)
+        self.params = kwargs
+
+        if vectorized is None:
+            vectorized = default_vectorized
+        self.vectorized = bool(vectorized) and self.extrusion() is not None
+
+        params = dict(kwargs, vectorized=True) if self.vectorized else kwargs
+        self.key = (self.__class__.__name__, tuple(sorted(params.items())))
+
+    @classmethod
+    def from_params(cls, vectorized=False, **params):
+        """Recreates a material from the parameters recorded in its key."""
+        maker = cls.__new__(cls)
+        Material.__init__(maker, vectorized, **params)
+        return maker
+
+    def create(self):
+        if not self.vectorized:
+            return super().create()
+
+        arrays = extrude(**self.extrusion())
+        return NodePath(make_geom_node(self.__class__.__name__, *arrays))
+
+    def extrusion(self):
+        """Returns the arguments of extrude() making this material, or None."""
+        return None
 
-    def __init__(self, radius, height, inner_radius=0, segs_c=40, ring_slice_deg=0):
+    def reduced(self):
+        """Returns this material with fewer segments for distant LOD levels:
+           circumferences are halved and straight walls and caps are not subdivided.
+        """
+        params = dict(self.params)
+
+        for name, value in params.items():
+            if name in ('segs_c', 'segs_h', 'segs_v', 'segs_r', 'segs_s'):
+                params[name] = max(value // 2, min(value, 8))
+            elif name.startswith('segs_'):
+                params[name] = min(value, 1)
+
+        return self.from_params(self.vectorized, **params)
+
+    def collision_primitive(self):
+        """Returns the Bullet primitive ('box', 'cylinder' or 'capsule') that can replace
+           the convex hull of this material and the largest distance between them,
+           or None if no primitive fits.
+        """
+        return None
+
+
+def sagitta(radius, segs):
+    return radius * (1 - math.cos(math.pi / segs))
+
+
+class MaterialCylinder(Material, Cylinder):
+
+    def __init__(self, radius, height, inner_radius=0, segs_c=40, ring_slice_deg=0, policy=None,
+                 vectorized=None):
+        policy = get_policy(policy)
         super().__init__(
+            vectorized=vectorized,
             radius=radius,
             inner_radius=inner_radius,
             height=height,
-            segs_c=segs_c,
+            segs_c=policy.circular(segs_c),
             ring_slice_deg=ring_slice_deg,
-            segs_a=int(height / 2) if height >= 3 else 1,
-            segs_top_cap=int((radius - inner_radius) / 2),
-            segs_bottom_cap=int((radius - inner_radius) / 2)
+            segs_a=policy.linear(height),
+            segs_top_cap=policy.cap(radius - inner_radius),
+            segs_bottom_cap=policy.cap(radius - inner_radius)
         )
 
         self.is_convex = not (inner_radius and ring_slice_deg)
 
+    def collision_primitive(self):
+        if not self.params['ring_slice_deg']:
+            return 'cylinder', sagitta(self.params['radius'], self.params['segs_c'])
+
+    def extrusion(self):
+        p = self.params
+        if p['inner_radius'] or p['ring_slice_deg']:
+            return None
+
+        points, normals = circle_outline(p['radius'], p['radius'], p['segs_c'])
+        return dict(points=points, normals=normals, bottom=0, top=p['height'],
+                    segs_z=p['segs_a'], rings=p['segs_top_cap'])
 
-class MaterialEllipticalPrism(EllipticalPrism):
+
+class MaterialEllipticalPrism(Material, EllipticalPrism):
 
     def __init__(self, major_axis, minor_axis, height, thickness=0.,
-                 segs_c=40, ring_slice_deg=0):
+                 segs_c=40, ring_slice_deg=0, policy=None, vectorized=None):
+        policy = get_policy(policy)
         super().__init__(
+            vectorized=vectorized,
             major_axis=major_axis,
             minor_axis=minor_axis,
             thickness=thickness,
             height=height,
-            segs_c=segs_c,
-            segs_a=int(height / 2) if height >= 3 else 1,
-            segs_top_cap=int(minor_axis / 2),
-            segs_bottom_cap=int(minor_axis / 2),
+            segs_c=policy.circular(segs_c),
+            segs_a=policy.linear(height),
+            segs_top_cap=policy.cap(minor_axis),
+            segs_bottom_cap=policy.cap(minor_axis),
             ring_slice_deg=ring_slice_deg
         )
 
         self.is_convex = True
 
+    def extrusion(self):
+        p = self.params
+        if p['thickness'] or p['ring_slice_deg']:
+            return None
+
+        points, normals = circle_outline(p['major_axis'], p['minor_axis'], p['segs_c'])
+        return dict(points=points, normals=normals, bottom=0, top=p['height'],
+                    segs_z=p['segs_a'], rings=p['segs_top_cap'])
+
 
-class MaterialCapsule(Capsule):
+class MaterialCapsule(Material, Capsule):
 
     def __init__(self, radius=1., inner_radius=0., height=1., segs_c=40,
-                 top_hemisphere=True, bottom_hemisphere=True, ring_slice_deg=0):
+                 top_hemisphere=True, bottom_hemisphere=True, ring_slice_deg=0, policy=None):
+        policy = get_policy(policy)
         super().__init__(
             radius=radius,
             inner_radius=inner_radius,
             height=height,
-            segs_c=segs_c,
-            segs_a=int(height / 2) if height >= 3 else 1,
-            segs_top_cap=int((radius - inner_radius) / 2),
-            segs_bottom_cap=int((radius - inner_radius) / 2),
+            segs_c=policy.circular(segs_c),
+            segs_a=policy.linear(height),
+            segs_top_cap=policy.cap(radius - inner_radius),
+            segs_bottom_cap=policy.cap(radius - inner_radius),
             top_hemisphere=top_hemisphere,
             bottom_hemisphere=bottom_hemisphere,
             ring_slice_deg=ring_slice_deg
@@ -62,18 +232,24 @@ class MaterialCapsule(Capsule):
 
         self.is_convex = not (inner_radius and ring_slice_deg)
 
+    def collision_primitive(self):
+        p = self.params
+        if not p['ring_slice_deg'] and p['top_hemisphere'] and p['bottom_hemisphere']:
+            return 'capsule', sagitta(p['radius'], p['segs_c'])
 
-class MaterialCapsulePrism(CapsulePrism):
+
+class MaterialCapsulePrism(Material, CapsulePrism):
 
     def __init__(self, width, depth, height, thickness=0., rounded_left=True,
-                 rounded_right=True, open_top=False, open_bottom=False):
+                 rounded_right=True, open_top=False, open_bottom=False, policy=None):
+        policy = get_policy(policy)
         super().__init__(
             width=width,
             depth=depth,
             height=height,
-            segs_w=int(width / 2) if width >= 3 else 1,
-            segs_d=int(depth / 2) if depth >= 3 else 1,
-            segs_z=int(height / 2) if height >= 3 else 1,
+            segs_w=policy.linear(width),
+            segs_d=policy.linear(depth),
+            segs_z=policy.linear(height),
             thickness=thickness,
             rounded_left=rounded_left,
             rounded_right=rounded_right,
@@ -84,18 +260,23 @@ class MaterialCapsulePrism(CapsulePrism):
         self.is_convex = True
 
 
-class MaterialRoundedCornerBox(RoundedCornerBox):
+class MaterialRoundedCornerBox(Material, RoundedCornerBox):
+
+    # segments of each rounded corner made by extrusion()
+    corner_segs = 8
 
     def __init__(self, width=2., depth=2., height=2., thickness=0., open_top=False,
                  open_bottom=False, corner_radius=0.5, rounded_f_left=True, rounded_f_right=True,
-                 rounded_b_left=True, rounded_b_right=True):
+                 rounded_b_left=True, rounded_b_right=True, policy=None, vectorized=None):
+        policy = get_policy(policy)
         super().__init__(
+            vectorized=vectorized,
             width=width,
             depth=depth,
             height=height,
-            segs_w=int(width / 2) if width >= 3 else 1,
-            segs_d=int(depth / 2) if depth >= 3 else 1,
-            segs_z=int(height / 2) if height >= 3 else 1,
+            segs_w=policy.linear(width),
+            segs_d=policy.linear(depth),
+            segs_z=policy.linear(height),
             thickness=thickness,
             open_top=open_top,
             open_bottom=open_bottom,
@@ -108,18 +289,65 @@ class MaterialRoundedCornerBox(RoundedCornerBox):
 
         self.is_convex = True
 
+    def collision_primitive(self):
+        rounded = any(self.params[k] for k in
+                      ('rounded_f_left', 'rounded_f_right', 'rounded_b_left', 'rounded_b_right'))
+        # distance from the corner of the box to the rounded corner.
+        return 'box', (self.params['corner_radius'] * (math.sqrt(2) - 1) if rounded else 0)
 
-class MaterialSphere(Sphere):
+    def extrusion(self):
+        p = self.params
+        if p['thickness']:
+            return None
 
-    def __init__(self, radius, inner_radius=0, segs_h=40, segs_v=40, segs_bottom_cap=2,
-                 segs_top_cap=2, slice_deg=0, bottom_clip=-1., top_clip=1):
+        w, d = p['width'] / 2, p['depth'] / 2
+        r = min(p['corner_radius'], w, d)
+        # corners counterclockwise from the front right, with the start angles of their arcs.
+        corners = [
+            (w, -d, -90, p['rounded_f_right']),
+            (w, d, 0, p['rounded_b_right']),
+            (-w, d, 90, p['rounded_b_left']),
+            (-w, -d, 180, p['rounded_f_left'])
+        ]
+        arcs = []
+
+        for x, y, start, rounded in corners:
+            # a sharp corner is an arc of no radius, giving the point with the normals of both sides.
+            radius = r if rounded else 0
+            angles = np.radians(np.linspace(start, start + 90, (self.corner_segs if rounded else 1) + 1))
+            arc = np.stack([np.cos(angles), np.sin(angles)], axis=-1)
+            center = [x - np.sign(x) * radius, y - np.sign(y) * radius]
+            arcs.append((center + arc * radius, arc))
+
+        points = []
+        normals = []
+
+        for i, segs in enumerate([p['segs_d'], p['segs_w'], p['segs_d'], p['segs_w']]):
+            arc_points, arc_normals = arcs[i]
+            end = arc_points[-1]
+            t = np.linspace(0, 1, segs + 1)[1:-1, None]
+            points += [arc_points, end + (arcs[(i + 1) % 4][0][0] - end) * t]
+            normals += [arc_normals, np.tile(arc_normals[-1], (len(t), 1))]
+
+        points.append(points[0][:1])
+        normals.append(normals[0][:1])
 
-        segs_cap = int(radius * 2 / 2) if radius * 2 >= 3 else 1
+        return dict(points=np.concatenate(points), normals=np.concatenate(normals),
+                    bottom=-p['height'] / 2, top=p['height'] / 2, segs_z=p['segs_z'],
+                    open_top=p['open_top'], open_bottom=p['open_bottom'])
+
+
+class MaterialSphere(Material, Sphere):
+
+    def __init__(self, radius, inner_radius=0, segs_h=40, segs_v=40, segs_bottom_cap=2,
+                 segs_top_cap=2, slice_deg=0, bottom_clip=-1., top_clip=1, policy=None):
+        policy = get_policy(policy)
+        segs_cap = policy.linear(radius * 2)
         super().__init__(
             radius=radius,
             inner_radius=inner_radius,
-            segs_h=segs_h,
-            segs_v=segs_v,
+            segs_h=policy.circular(segs_h),
+            segs_v=policy.circular(segs_v),
             segs_bottom_cap=segs_cap,
             segs_top_cap=segs_cap,
             slice_deg=slice_deg,
@@ -130,14 +358,23 @@ class MaterialSphere(Sphere):
         self.is_convex = False
 
 
-class MaterialTorus(Torus):
+class MaterialTorus(Material, Torus):
+
+    torus_segs = dict(segs_r=24, segs_s=12)
+
+    def __init__(self, ring_radius=1., section_radius=.5, ring_slice_deg=0, section_slice_deg=0,
+                 segs_r=24, segs_s=12, policy=None):
+        policy = get_policy(policy)
+        # pass only the counts that differ from the defaults of Torus to keep the keys unchanged.
+        segs = {name: policy.circular(n) for name, n in (('segs_r', segs_r), ('segs_s', segs_s))}
+        segs = {name: n for name, n in segs.items() if n != self.torus_segs[name]}
 
-    def __init__(self, ring_radius=1., section_radius=.5, ring_slice_deg=0, section_slice_deg=0):
         super().__init__(
             ring_radius=ring_radius,
             section_radius=section_radius,
             ring_slice_deg=ring_slice_deg,
-            section_slice_deg=section_slice_deg
+            section_slice_deg=section_slice_deg,
+            **segs
         )
 
         self.is_convex = False
@@ -0,0 +1,116 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+from panda3d.core import NodePath
+
+import building_materials
+from profiling import profiler
+
+
+def maker_from_key(key):
+    name, params = key
+    return getattr(building_materials, name).from_params(**dict(params))
+
+
+def create_geom(key):
+    """Generates the geometry of a maker in a worker process
+       and returns it serialized as a bam stream.
+    """
+    return maker_from_key(key).create().encode_to_bam_stream()
+
+
+class GeomCache:
+    """Generates the geometry of each maker only once, keyed by its parameters,
+       and hands out copies sharing the same Geoms for later placements.
+    """
+
+    def __init__(self):
+        self.models = {}
+        self.hits = 0
+        self.misses = 0
+        self.planned = None
+
+    def __len__(self):
+        return len(self.models)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(geoms={len(self)}, hits={self.hits}, misses={self.misses})'
+
+    def get(self, maker):
+        """Returns a copy of the maker's geometry, or None while planning."""
+        if self.planned is not None:
+            self.planned.add(maker.key)
+            return None
+
+        if (model := self.models.get(maker.key)) is None:
+            with profiler.span(maker.__class__.__name__, 'maker'):
+                model = self.models[maker.key] = maker.create()
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return NodePath(model.node().copy_subgraph())
+
+    @contextmanager
+    def plan(self):
+        """Collects the keys of the makers requested by get() without generating anything."""
+        self.planned = set()
+        try:
+            yield self.planned
+        finally:
+            self.planned = None
+
+    def generate(self, keys, workers):
+        """Generates the geometry of the keys not cached yet in worker processes."""
+        keys = [key for key in keys if key not in self.models]
+        chunksize = max(1, len(keys) // (workers * 4))
+
+        # forked workers would inherit the window and the GL context of ShowBase.
+        context = multiprocessing.get_context('spawn')
+
+        with profiler.span('process pool', 'maker'), \
+                ProcessPoolExecutor(workers, mp_context=context) as executor:
+            for key, data in zip(keys, executor.map(create_geom, keys, chunksize=chunksize)):
+                self.models[key] = NodePath.decode_from_bam_stream(data)
+                self.misses += 1
+
+    def clear(self):
+        self.models.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class ShapeCache:
+    """Shares one Bullet shape between all pieces made with the same parameters;
+       the placement of each piece is given by the transform passed to add_shape.
+    """
+
+    def __init__(self):
+        self.shapes = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(shapes={len(self)}, hits={self.hits}, misses={self.misses})'
+
+    def get(self, key, make_shape):
+        if (shape := self.shapes.get(key)) is None:
+            shape = self.shapes[key] = make_shape()
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return shape
+
+    def clear(self):
+        self.shapes.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+geom_cache = GeomCache()
+shape_cache = ShapeCache()
@@ -1,12 +1,16 @@
-import random
+import copy
 from enum import Enum
+from functools import cache
+
+import numpy as np
 
 from panda3d.bullet import BulletRigidBodyNode
 from panda3d.bullet import BulletTriangleMeshShape, BulletTriangleMesh
 from panda3d.bullet import BulletConvexHullShape, BulletCylinderShape, ZUp
-from panda3d.core import NodePath
-from panda3d.core import BitMask32, Vec3, Point3, LColor
-from panda3d.core import TransformState
+from panda3d.bullet import BulletBoxShape, BulletCapsuleShape
+from panda3d.core import NodePath, LODNode, OccluderNode, BoundingVolume
+from panda3d.core import BitMask32, Vec3, Point3, LColor, Mat4
+from panda3d.core import TransformState, Texture, TextureStage, SamplerState
 
 
 from building_materials import MaterialCylinder as Cylinder
@@ -16,6 +20,9 @@ from building_materials import MaterialCapsulePrism as CapsulePrism
 from building_materials import MaterialRoundedCornerBox as RoundedBox
 from building_materials import MaterialSphere as Sphere
 from building_materials import MaterialTorus as Torus
+from caches import geom_cache, shape_cache
+from geom_utils import get_vertices, cluster_points, make_box
+from profiling import profiler
 
 
 class Color(Enum):
@@ -48,50 +55,280 @@ class Color(Enum):
     COLOR_26 = (1.0, 0.67, 0.91)
 
     @classmethod
-    def random_choice(cls):
-        c = random.choice(list(cls))
-        return LColor(*c.value, 1)
+    @cache
+    def palette(cls):
+        """Returns the rgba of the colors as a (n, 4) array, made once."""
+        palette = np.ones((len(cls), 4), dtype=np.float32)
+        palette[:, :3] = [c.value for c in cls]
+        palette.flags.writeable = False
+        return palette
+
+    @classmethod
+    def choices(cls, rng, n):
+        """Returns n colors drawn by the numpy Generator rng as a (n, 4) array."""
+        palette = cls.palette()
+        return palette[rng.integers(0, len(palette), n)]
+
+    @classmethod
+    @cache
+    def palette_texture(cls):
+        """Returns a texture of one texel per color, made once, which buildings flattened
+           with palette colors look up by their texcoords.
+        """
+        # padded to a power of two, which textures are otherwise scaled to.
+        texels = np.ones((cls.palette_size(), 4))
+        texels[:len(cls)] = cls.palette()
+
+        tex = Texture('palette')
+        tex.setup_2d_texture(len(texels), 1, Texture.T_unsigned_byte, Texture.F_rgba8)
+        # the ram image is in blue, green, red and alpha order.
+        tex.set_ram_image(np.round(texels[:, [2, 1, 0, 3]] * 255).astype(np.uint8).tobytes())
+        tex.set_minfilter(SamplerState.FT_nearest)
+        tex.set_magfilter(SamplerState.FT_nearest)
+        tex.set_wrap_u(SamplerState.WM_clamp)
+        tex.set_wrap_v(SamplerState.WM_clamp)
+        return tex
+
+    @classmethod
+    def palette_size(cls):
+        return 1 << (len(cls) - 1).bit_length()
+
+    @classmethod
+    def palette_coord(cls, color, tolerance=1 / 512):
+        """Returns the u texcoord of the texel of the palette color equal to color
+           within tolerance, or None if color is not in the palette, e.g. one of a layout.
+        """
+        diff = np.abs(cls.palette()[:, :3] - tuple(color)[:3]).max(axis=-1)
+        if diff[i := diff.argmin()] > tolerance:
+            return None
+
+        return (i + 0.5) / cls.palette_size()
+
+    @classmethod
+    def random_choice(cls, rng=None):
+        rng = np.random.default_rng() if rng is None else rng
+        return LColor(*cls.choices(rng, 1)[0])
 
 
 class Building(NodePath):
 
-    def __init__(self, name, pos, hpr):
+    # How convex pieces collide:
+    # 'full': convex hull of all vertices of the render geometry.
+    # 'reduced': convex hull of the vertices merged within hull_tolerance,
+    #            at most hull_max_points.
+    # 'primitive': box, cylinder or capsule shape if the maker's primitive
+    #              is within hull_tolerance, otherwise the same as 'reduced'.
+    hull_mode = 'full'
+    hull_tolerance = 0.5
+    hull_max_points = 64
+
+    def __init__(self, name, pos, hpr, color=None):
         super().__init__(BulletRigidBodyNode(f'building_{name}'))
         self.set_tag('category', 'object')
         self.node().set_mass(0)
         self.set_collide_mask(BitMask32.bit(1))
         self.set_pos_hpr(pos, hpr)
-        self.set_color(Color.random_choice())
+        # buildings without a color are painted by City.assign_colors after the build.
+        if color is not None:
+            self.set_color(color)
+        self.node().set_bounds_type(BoundingVolume.BT_box)
+        self.pieces = []
 
-    def add_collision_shape(self, model, is_convex):
-        if is_convex:
-            shape = BulletConvexHullShape()
-            shape.add_geom(model.node().get_geom(0))
-        else:
+    def add_collision_shape(self, model, is_convex, maker=None):
+        offset = TransformState.make_identity()
+
+        if not is_convex:
             mesh = BulletTriangleMesh()
             mesh.add_geom(model.node().get_geom(0))
             shape = BulletTriangleMeshShape(mesh, dynamic=False)
+        elif self.hull_mode == 'full':
+            shape = BulletConvexHullShape()
+            shape.add_geom(model.node().get_geom(0))
+        else:
+            points = get_vertices(model.node())
+            primitive = maker.collision_primitive() if maker and self.hull_mode == 'primitive' else None
 
-        return shape
+            if primitive and primitive[1] <= self.hull_tolerance:
+                shape, offset = self.make_primitive_shape(primitive[0], points)
+            else:
+                shape = BulletConvexHullShape()
+                for pt in cluster_points(points, self.hull_tolerance, self.hull_max_points):
+                    shape.add_point(Point3(*pt))
+
+        return shape, offset
+
+    def make_primitive_shape(self, primitive, points):
+        lower = points.min(axis=0)
+        upper = points.max(axis=0)
+        half = Vec3(*(upper - lower) / 2)
+        offset = TransformState.make_pos(Point3(*(upper + lower) / 2))
+
+        match primitive:
+            case 'box':
+                shape = BulletBoxShape(half)
+            case 'cylinder':
+                shape = BulletCylinderShape(max(half.x, half.y), half.z * 2, ZUp)
+            case 'capsule':
+                radius = max(half.x, half.y)
+                shape = BulletCapsuleShape(radius, max(half.z - radius, 0) * 2, ZUp)
+
+        return shape, offset
+
+    def get_collision_shape(self, maker, model):
+        key = (maker.key, maker.is_convex, self.hull_mode, self.hull_tolerance, self.hull_max_points)
+        def make_shape():
+            with profiler.span(maker.__class__.__name__, 'shape'):
+                return self.add_collision_shape(model, maker.is_convex, maker)
+
+        return shape_cache.get(key, make_shape)
+
+    def add_piece(self, maker, transform):
+        self.pieces.append((maker, transform))
+
+        # nothing is generated while the geometry cache is planning.
+        if (model := geom_cache.get(maker)) is None:
+            return
+
+        shape, offset = self.get_collision_shape(maker, model)
+        self.node().add_shape(shape, transform.compose(offset))
+        model.set_transform(transform)
+        model.reparent_to(self)
 
+    @profiler.timed('piece', detailed=True)
     def build(self, maker, is_convex=True):
-        model = maker.create()
-        shape = self.add_collision_shape(model, maker.is_convex)
-        self.node().add_shape(shape)
-        model.reparent_to(self)
+        self.add_piece(maker, TransformState.make_identity())
 
+    @profiler.timed('piece', detailed=True)
     def assemble(self, maker, pos, hpr, is_convex=True):
-        model = maker.create()
-        shape = self.add_collision_shape(model, maker.is_convex)
-        self.node().add_shape(shape, TransformState.make_pos_hpr(pos, hpr))
-        model.set_pos_hpr(pos, hpr)
-        model.reparent_to(self)
+        self.add_piece(maker, TransformState.make_pos_hpr(pos, hpr))
+
+    def make_lod(self, near, far):
+        """Switches the geometry to the pieces made by reduced makers beyond near,
+           and to a box of the bounds of the building beyond far.
+        """
+        lod_np = NodePath(LODNode('lod'))
+        high = lod_np.attach_new_node('high')
+        middle = lod_np.attach_new_node('middle')
+
+        for model in self.get_children():
+            model.reparent_to(high)
+
+        for maker, transform in self.pieces:
+            model = geom_cache.get(maker.reduced())
+            model.set_transform(transform)
+            model.reparent_to(middle)
+
+        lower, upper = high.get_tight_bounds()
+        lod_np.attach_new_node(make_box('impostor', lower, upper))
+
+        lod = lod_np.node()
+        lod.add_switch(near, 0)
+        lod.add_switch(far, near)
+        lod.add_switch(float('inf'), far)
+        lod.set_center((lower + upper) / 2)
+        lod_np.reparent_to(self)
+
+    def get_occluder_core(self, min_height=20, min_radius=4):
+        """Returns (x, y, radius, bottom, top) of a vertical cylinder that fits inside
+           the stack of solid pieces standing on the ground, or None if it is too small.
+           Spheres, tori, domes, hollow or open pieces, sliced rings and tilted pieces
+           are not counted as solid.
+        """
+        pieces = []
+
+        for maker, transform in self.pieces:
+            p = maker.params
+            if isinstance(maker, (Sphere, Torus)) or p.get('ring_slice_deg') \
+                    or p.get('top_hemisphere') or p.get('bottom_hemisphere'):
+                continue
+
+            # the geometry behind the hole is visible through it.
+            if p.get('inner_radius') or p.get('thickness') or p.get('open_top') or p.get('open_bottom'):
+                continue
+
+            if abs(transform.get_hpr().y) > 0.01 or abs(transform.get_hpr().z) > 0.01:
+                continue
+
+            lower, upper = geom_cache.models[maker.key].get_tight_bounds()
+            # the inscribed circle of boxes, cylinders, ellipses and capsule prisms.
+            radius = min(upper.x - lower.x, upper.y - lower.y) / 2
+            center = transform.get_mat().xform_point((lower + upper) / 2)
+            z = transform.get_pos().z
+            pieces.append((z + lower.z, z + upper.z, center.x, center.y, radius))
+
+        if not pieces:
+            return None
+
+        pieces.sort()
+        bottom, top, x, y, radius = pieces[0]
+
+        for z0, z1, cx, cy, r in pieces[1:]:
+            if z0 > top + 0.01:
+                break
+            radius = min(radius, r - ((cx - x) ** 2 + (cy - y) ** 2) ** 0.5)
+            top = max(top, z1)
+
+        if bottom > 1 or top - bottom < min_height or radius < min_radius:
+            return None
+
+        return x, y, radius, bottom, top
+
+    def add_occluders(self, x, y, radius, bottom, top):
+        """Adds two crossing quads inside the solid core as occluders,
+           so that one of them always faces the camera.
+        """
+        occluders = []
+
+        for dx, dy in ((radius, 0), (0, radius)):
+            occluder = OccluderNode('occluder')
+            occluder.set_double_sided(True)
+            occluder.set_vertices(
+                Point3(x - dx, y - dy, bottom), Point3(x + dx, y + dy, bottom),
+                Point3(x + dx, y + dy, top), Point3(x - dx, y - dy, top)
+            )
+            occluders.append(self.attach_new_node(occluder))
+
+        return occluders
+
+    def get_palette_transform(self):
+        """Returns the texture transform moving every texcoord onto the texel
+           of the color of the building in Color.palette_texture(),
+           or None if the color is not in the palette.
+        """
+        if (u := Color.palette_coord(self.get_color())) is None:
+            return None
+
+        return TransformState.make_mat(Mat4(0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, u, 0.5, 0, 1))
+
+    def flatten(self, palette=False):
+        """Bakes the transforms of the pieces into their vertices and merges them
+           into as few Geoms as possible. Bullet nodes do not flatten their children,
+           so the pieces are gathered under an intermediate node.
+           If palette is True, the color of the building is baked into the texcoords
+           instead of being kept in the state of the building, unless it is not in the palette.
+        """
+        geom_root = NodePath('geometry')
+
+        for model in self.get_children():
+            model.reparent_to(geom_root)
+
+        if palette:
+            if (transform := self.get_palette_transform()) is not None:
+                geom_root.set_tex_transform(TextureStage.get_default(), transform)
+                self.clear_color()
+            else:
+                # keeps its own color, without the palette texture of its group.
+                geom_root.set_texture_off()
+
+        geom_root.reparent_to(self)
+        geom_root.flatten_strong()
 
 
 class PineTree(NodePath):
 
     def __init__(self, model, name, scale=1.5):
         super().__init__(BulletRigidBodyNode(f'tree_{name}'))
+        self.set_tag('category', 'tree')
         tree = model.copy_to(self)
         tree.set_transform(TransformState.make_pos(Vec3(0, 0, -4)))
         tree.reparent_to(self)
@@ -108,18 +345,143 @@ class City:
 
     areas = []
 
-    def __init_subclass__(cls):
+    # None: keep every piece as its own node, 'building': merge the pieces of each building,
+    # 'area': merge all buildings of the area into one node, leaving Bullet nodes without
+    # geometry; buildings can then be picked but not moved by positioning.
+    flatten_mode = None
+
+    # set on the copies that only run the build to collect the makers it uses,
+    # which then neither plant trees nor attach anything.
+    planning = False
+
+    def __init__(self, root=None, seed=None):
+        self.buildings = []
+        self.groups = {}
+        # If root is given, models are parented to it instead of city_root,
+        # and attaching their Bullet nodes to the world is left to the caller.
+        self.root = root
+        # seed may also be a numpy SeedSequence; unpredictable if None.
+        self.rng = np.random.default_rng(seed)
+
+    def __init_subclass__(cls, register=True):
         super().__init_subclass__()
         if 'build' not in cls.__dict__:
             raise NotImplementedError('Subclasses must implement build method')
 
-        City.areas.append(cls)
+        if register:
+            City.areas.append(cls)
+
+    @staticmethod
+    def create_areas(seed=None):
+        """Returns a builder of each hand-authored area. Their random generators
+           are spawned from seed, so that the areas do not draw the same colors.
+        """
+        seeds = np.random.SeedSequence(seed).spawn(len(City.areas))
+        return [area(seed=area_seed) for area, area_seed in zip(City.areas, seeds)]
+
+    def detached(self, root, planning=False):
+        """Returns a copy of this builder that builds under root."""
+        builder = copy.copy(self)
+        builder.root = root
+        builder.planning = planning
+        builder.buildings = []
+        builder.groups = {}
+        return builder
+
+    def get_root(self):
+        return base.scene.city_root if self.root is None else self.root
+
+    def get_group_name(self, model):
+        return self.__class__.__name__.lower()
+
+    def get_group(self, model):
+        """Returns the node grouping the models of the same area under the root,
+           so that culling can skip a whole group by its bounding box.
+        """
+        name = self.get_group_name(model)
+
+        if (group := self.groups.get(name)) is None:
+            group = self.groups[name] = self.get_root().attach_new_node(name)
+            group.node().set_bounds_type(BoundingVolume.BT_box)
+
+        return group
 
     def attach(self, model):
-        model.reparent_to(base.scene.city_root)
-        base.world.attach(model.node())
+        if self.planning:
+            return
+
+        model.reparent_to(self.get_group(model))
+
+        if self.root is None:
+            base.world.attach(model.node())
+
+        if isinstance(model, Building):
+            self.buildings.append(model)
+
+    def assign_colors(self):
+        """Paints the buildings that have no color yet with colors of the palette,
+           all drawn at once from the random generator of the builder.
+        """
+        buildings = [building for building in self.buildings if not building.has_color()]
+
+        for building, color in zip(buildings, Color.choices(self.rng, len(buildings))):
+            building.set_color(LColor(*color))
+
+    def make_lods(self, near, far):
+        for building in self.buildings:
+            building.make_lod(near, far)
+
+    def flatten(self, mode=None, palette=False):
+        """palette: if True, the buildings take their colors from Color.palette_texture()
+                    applied to their groups, so that they all share one render state.
+                    Only applies to flattened buildings; the ones whose color is not
+                    in the palette keep their own color states.
+        """
+        match mode or self.flatten_mode:
+            case 'building':
+                for building in self.buildings:
+                    building.flatten(palette)
+
+            case 'area':
+                # the geometry of each group is merged separately to keep it cullable.
+                geom_roots = {}
+
+                for building in self.buildings:
+                    group = building.get_parent()
+                    if (geom_root := geom_roots.get(group)) is None:
+                        geom_root = geom_roots[group] = group.attach_new_node('geometry')
+
+                    palette_transform = building.get_palette_transform() if palette else None
+
+                    for model in building.get_children():
+                        # the color of the building is baked into the vertices.
+                        if palette_transform is not None:
+                            model.set_tex_transform(TextureStage.get_default(), palette_transform)
+                        else:
+                            model.set_color(building.get_color())
+                            if palette:
+                                model.set_texture_off()
+                        model.wrt_reparent_to(geom_root)
+
+                for geom_root in geom_roots.values():
+                    geom_root.flatten_strong()
+
+            case _:
+                return
+
+        if palette:
+            for group in self.groups.values():
+                group.set_texture(Color.palette_texture())
 
     def plant_trees(self, *pos_xy):
+        if self.planning:
+            return
+
+        # the Forest is grown once, so detached builds plant their own trees.
+        if self.root is None and base.scene.forest is not None:
+            base.scene.forest.plant(*pos_xy)
+            return
+
         model = base.loader.load_model('models/pinetree/tree2.bam')
         area = self.__class__.__name__.lower()
 
@@ -135,6 +497,7 @@ class City:
         if attach:
             self.attach(building)
 
+    @profiler.timed('stack')
     def stack_shifting_boxes(self, building, n, maker, dirs, shift, start_z=0):
         """dirs: [(0, -1), (1, 0), (0, 1), (-1, 0)]
         """
@@ -156,6 +519,7 @@ class City:
 
         self.attach(building)
 
+    @profiler.timed('stack')
     def stack_alternating_box_center(self, building, n, maker_1, maker_2, dir_x=0, dir_y=0,
                                      shift_x=0, shift_y=0, start_x=0, start_y=0, start_z=0):
         z = 0
@@ -176,6 +540,7 @@ class City:
 
         self.attach(building)
 
+    @profiler.timed('stack')
     def stack_alternating_boxes(self, building, n, maker_1, maker_2, x=0, y=0, start_z=0, h=0, attach=True):
         z = 0
 
@@ -188,6 +553,7 @@ class City:
         if attach:
             self.attach(building)
 
+    @profiler.timed('stack')
     def stack_shifting_prisms(self, building, n, maker, dirs, shift, start_z=0):
         """dirs: [(0, -1), (1, 0), (0, 1), (-1, 0)]
         """
@@ -208,6 +574,7 @@ class City:
 
         self.attach(building)
 
+    @profiler.timed('stack')
     def stack_alternating_prisms(self, building, n, maker_1, maker_2, x=0, y=0, z=0, h=0, attach=True):
 
         for i in range(n):
@@ -218,6 +585,7 @@ class City:
         if attach:
             self.attach(building)
 
+    @profiler.timed('stack')
     def stack_rotating_prisms(self, building, maker, n, angles, x=0, y=0, z=0, attach=True):
         z = 0
 
@@ -229,6 +597,7 @@ class City:
         if attach:
             self.attach(building)
 
+    @profiler.timed('stack')
     def stack_rotating_boxes(self, building, maker, n, angles, x=0, y=0, start_z=0, attach=True):
         z = 0
         i = 0
@@ -0,0 +1,93 @@
+import glob
+import hashlib
+import os
+
+from panda3d.core import NodePath, Texture, SamplerState
+
+
+class BakedCity:
+    """Stores the built city, including the Bullet bodies and their shapes,
+       in a bam file named after a hash of the sources the city is built from
+       and the options passed to Scene.create_city, so that a later launch
+       with the same inputs loads the file instead of generating the meshes.
+       A bam stream cannot be decoded from a memory map in place,
+       so the file is read with a single read call.
+    """
+
+    sources = ['city.py', 'building_materials.py', 'geom_utils.py', 'procedural.py', 'forest.py',
+               'layouts.py', 'light_baking.py', 'picking.py', 'lights.py', 'scene.py', 'shapes/src/*.py']
+
+    def __init__(self, options, cache_dir='cache'):
+        self.cache_dir = cache_dir
+        self.path = os.path.join(cache_dir, f'city_{self.make_hash(options)}.bam')
+
+    def make_hash(self, options):
+        h = hashlib.sha256()
+
+        for pattern in self.sources:
+            for path in sorted(glob.glob(pattern)):
+                with open(path, 'rb') as f:
+                    h.update(f.read())
+
+        h.update(repr(sorted(options.items())).encode())
+        return h.hexdigest()[:16]
+
+    def load(self, city_root):
+        """Moves the baked city under city_root and attaches its bodies to the world.
+           Returns False if there is no bake for the current hash, or if it cannot be
+           decoded, in which case the file is removed so that the city is baked again.
+        """
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path, 'rb') as f:
+            baked = NodePath.decode_from_bam_stream(f.read())
+
+        if baked.is_empty():
+            os.remove(self.path)
+            return False
+
+        for child in baked.get_children():
+            child.reparent_to(city_root)
+
+        for body in city_root.find_all_matches('**/+BulletBodyNode'):
+            base.world.attach(body.node())
+
+        return True
+
+    def save(self, city_root):
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # bakes made from older sources or options are never loaded again.
+        for path in glob.glob(os.path.join(self.cache_dir, 'city_*.bam')):
+            os.remove(path)
+
+        with open(self.path, 'wb') as f:
+            f.write(city_root.encode_to_bam_stream())
+
+
+def load_cube_map(pattern, cache_dir='cache', compression=Texture.CM_dxt1):
+    """Loads the cube map of the six images matching pattern, # standing for the face,
+       from a txo file named after a hash of the images. The first launch writes the file
+       with the mipmaps generated and compressed, so that later ones decode no image.
+    """
+    h = hashlib.sha256()
+
+    for path in sorted(glob.glob(pattern.replace('#', '[0-9]'))):
+        with open(path, 'rb') as f:
+            h.update(f.read())
+
+    path = os.path.join(cache_dir, f'cube_map_{h.hexdigest()[:16]}.txo')
+
+    if os.path.exists(path):
+        return base.loader.load_texture(path)
+
+    tex = base.loader.load_cube_map(pattern)
+    tex.set_minfilter(SamplerState.FT_linear_mipmap_linear)
+    tex.generate_ram_mipmap_images()
+    # left uncompressed if Panda3D was built without a compressor.
+    tex.compress_ram_image(compression)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tex.write(path)
+    return tex
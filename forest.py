@@ -0,0 +1,101 @@
+import numpy as np
+from panda3d.bullet import BulletRigidBodyNode, BulletCylinderShape, ZUp
+from panda3d.core import NodePath
+from panda3d.core import BitMask32, Point3, Vec3
+from panda3d.core import Texture, GeomEnums, Shader, BoundingBox
+from panda3d.core import TransformState
+
+
+class Forest(NodePath):
+    """Renders all the trees of the city with one instanced draw call.
+       The position, scale and heading of each tree are read by the vertex shader
+       from a buffer texture, and the trees collide through one Bullet body
+       whose shapes are shared between trees of the same scale.
+       The buffer is also kept in a tag, so that a forest loaded from a bake,
+       which cannot store the shader, can be drawn again by restore().
+    """
+
+    def __init__(self, model_path='models/pinetree/tree2.bam', scale=1.5,
+                 scale_range=0., random_heading=True, seed=None):
+        super().__init__(BulletRigidBodyNode('forest'))
+        self.set_tag('category', 'tree')
+        self.model_path = model_path
+        self.scale = scale
+        self.scale_range = scale_range
+        self.random_heading = random_heading
+        self.rng = np.random.default_rng(seed)
+        self.trees = []
+
+        self.node().set_mass(0)
+        self.set_collide_mask(BitMask32.bit(1))
+
+    def plant(self, *pos_xy, z=6):
+        n = len(pos_xy)
+        scales = self.scale + self.rng.uniform(-self.scale_range, self.scale_range, n)
+        headings = self.rng.uniform(0, 360, n) if self.random_heading else np.zeros(n)
+
+        for (x, y), scale, h in zip(pos_xy, scales.tolist(), headings.tolist()):
+            self.trees.append((x, y, z, scale, h))
+
+    def grow(self):
+        """Builds the instanced model and the collision shapes of the planted trees."""
+        if not self.trees:
+            return
+
+        model = base.loader.load_model(self.model_path)
+        model.set_pos(Vec3(0, 0, -4))
+        model.flatten_strong()
+        model.reparent_to(self)
+
+        trees = np.array(self.trees, dtype=np.float32)
+        instances = np.zeros((len(trees), 2, 4), dtype=np.float32)
+        instances[:, 0] = trees[:, :4]
+        rad = np.radians(trees[:, 4])
+        instances[:, 1, 0] = np.cos(rad)
+        instances[:, 1, 1] = np.sin(rad)
+
+        self.set_tag('instances', instances.tobytes().hex())
+        self.instance(model, instances)
+
+        lower, upper = model.get_tight_bounds()
+        height = (upper - lower).z
+        shapes = {}
+
+        for x, y, z, scale, _ in self.trees:
+            key = round(scale, 1)
+            if (shape := shapes.get(key)) is None:
+                shape = shapes[key] = BulletCylinderShape(0.5 * key, height * key, ZUp)
+            self.node().add_shape(shape, TransformState.make_pos(Point3(x, y, z)))
+
+    @staticmethod
+    def instance(model, instances):
+        """Draws the model once for each of the (n, 2, 4) instances by the instancing shader."""
+        # the bounds of the single model must cover all instances, or it is culled.
+        trees = instances[:, 0]
+        lower, upper = model.get_tight_bounds()
+        max_scale = trees[:, 3].max()
+        radius = Vec3(max(-lower.x, upper.x), max(-lower.y, upper.y), 0).length() * max_scale
+        model.node().set_bounds(BoundingBox(
+            Point3(*trees[:, :2].min(axis=0) - radius, trees[:, 2].min() + lower.z * max_scale),
+            Point3(*trees[:, :2].max(axis=0) + radius, trees[:, 2].max() + upper.z * max_scale)
+        ))
+        model.node().set_final(True)
+
+        tex = Texture('tree_instances')
+        tex.setup_buffer_texture(len(instances) * 2, Texture.T_float, Texture.F_rgba32, GeomEnums.UH_static)
+        tex.set_ram_image(instances.tobytes())
+
+        shader = Shader.load(
+            Shader.SL_GLSL, 'shaders/instanced_tree.vert', 'shaders/instanced_tree.frag')
+        model.set_shader(shader)
+        model.set_shader_input('instances', tex)
+        model.set_instance_count(len(instances))
+
+    @classmethod
+    def restore(cls, forest_np):
+        """Sets the instancing shader and the bounds again on a forest loaded
+           from a bam file, which stores neither.
+        """
+        data = bytes.fromhex(forest_np.get_tag('instances'))
+        instances = np.frombuffer(data, dtype=np.float32).reshape(-1, 2, 4)
+        cls.instance(forest_np.get_child(0), instances)
@@ -0,0 +1,354 @@
+import numpy as np
+from panda3d.core import GeomEnums, Geom, GeomNode, GeomTriangles
+from panda3d.core import GeomVertexData, GeomVertexFormat, GeomVertexWriter
+from panda3d.core import GeomVertexArrayFormat, InternalName
+from panda3d.core import TextureAttrib, TransformState, Point3, Vec3
+
+
+NUMERIC_TYPES = {
+    GeomEnums.NT_float32: np.float32,
+    GeomEnums.NT_float64: np.float64,
+    GeomEnums.NT_int8: np.int8,
+    GeomEnums.NT_int16: np.int16,
+    GeomEnums.NT_int32: np.int32,
+    GeomEnums.NT_uint8: np.uint8,
+    GeomEnums.NT_uint16: np.uint16,
+    GeomEnums.NT_uint32: np.uint32,
+}
+
+
+def read_column(vdata, name):
+    """Returns the values of the named column of GeomVertexData
+       as a (rows, components) float array; 8 bit colors are scaled between 0 and 1.
+    """
+    fmt = vdata.get_format()
+    column = fmt.get_column(name)
+    array = vdata.get_array(fmt.get_array_with(name))
+    stride = array.get_array_format().get_stride()
+    start = column.get_start()
+    buf = np.frombuffer(memoryview(array).cast('B'), dtype=np.uint8).reshape(-1, stride)
+
+    # colors packed by flatten into a uint32 of alpha, red, green and blue from the highest byte.
+    if column.get_numeric_type() == GeomEnums.NT_packed_dabc:
+        return buf[:, start:start + 4][:, [2, 1, 0, 3]] / 255
+
+    dtype = np.dtype(NUMERIC_TYPES[column.get_numeric_type()])
+    n = column.get_num_components()
+    values = np.ascontiguousarray(buf[:, start:start + n * dtype.itemsize]).view(dtype)
+    values = values.reshape(-1, n).astype(np.float64)
+
+    if column.get_contents() == GeomEnums.C_color and dtype == np.uint8:
+        values /= 255
+
+    return values
+
+
+def write_column(vdata, name, values):
+    """Writes (rows, components) values into the named column of GeomVertexData;
+       8 bit colors are given between 0 and 1.
+    """
+    fmt = vdata.get_format()
+    column = fmt.get_column(name)
+    array = vdata.modify_array(fmt.get_array_with(name))
+    stride = array.get_array_format().get_stride()
+    start = column.get_start()
+    buf = np.frombuffer(memoryview(array).cast('B'), dtype=np.uint8).reshape(-1, stride)
+
+    if column.get_numeric_type() == GeomEnums.NT_packed_dabc:
+        buf[:, start:start + 4] = np.round(np.clip(values, 0, 1) * 255)[:, [2, 1, 0, 3]]
+        return
+
+    dtype = np.dtype(NUMERIC_TYPES[column.get_numeric_type()])
+    n = column.get_num_components()
+
+    if column.get_contents() == GeomEnums.C_color and dtype == np.uint8:
+        values = np.round(np.clip(values, 0, 1) * 255)
+
+    buf[:, start:start + n * dtype.itemsize] = \
+        np.ascontiguousarray(values, dtype=dtype).view(np.uint8).reshape(len(buf), -1)
+
+
+def with_color_column(vdata):
+    """Returns the GeomVertexData with an 8 bit color column added if it has none."""
+    if vdata.has_column('color'):
+        return vdata
+
+    array_format = GeomVertexArrayFormat()
+    array_format.add_column(InternalName.get_color(), 4, GeomEnums.NT_uint8, GeomEnums.C_color)
+    fmt = GeomVertexFormat(vdata.get_format())
+    fmt.add_array(array_format)
+    vdata = GeomVertexData(vdata.convert_to(GeomVertexFormat.register_format(fmt)))
+    write_column(vdata, 'color', np.ones((vdata.get_num_rows(), 4)))
+    return vdata
+
+
+VERTEX_FORMAT = GeomVertexFormat.get_v3n3c4t2()
+
+
+def make_geom_node(name, vertices, normals, texcoords, triangles):
+    """Returns a GeomNode of the triangles, filling its vertex and index arrays
+       in bulk through memoryviews instead of writing vertex by vertex.
+    """
+    vdata = GeomVertexData(name, VERTEX_FORMAT, Geom.UH_static)
+    vdata.unclean_set_num_rows(len(vertices))
+
+    for column, values in (('vertex', vertices), ('normal', normals), ('texcoord', texcoords)):
+        write_column(vdata, column, values)
+    write_column(vdata, 'color', np.ones((len(vertices), 4)))
+
+    prim = GeomTriangles(Geom.UH_static)
+    prim.set_index_type(GeomEnums.NT_uint16 if len(vertices) < 0xffff else GeomEnums.NT_uint32)
+    indices = prim.modify_vertices()
+    indices.unclean_set_num_rows(triangles.size)
+    dtype = NUMERIC_TYPES[prim.get_index_type()]
+    np.frombuffer(memoryview(indices).cast('B'), dtype=dtype)[:] = triangles.ravel()
+
+    geom = Geom(vdata)
+    geom.add_primitive(prim)
+    node = GeomNode(name)
+    node.add_geom(geom)
+    return node
+
+
+def extrude(points, normals, bottom, top, segs_z=1, rings=1, open_top=False, open_bottom=False):
+    """Returns the vertices, normals, texcoords and triangles of the prism made by extruding
+       a convex outline around the origin from bottom to top, with caps of concentric rings.
+        Args:
+            points (numpy.ndarray): (n, 2) counterclockwise outline whose last point
+                                    repeats the first one for the seam of the texture.
+            normals (numpy.ndarray): (n, 2) outward normals of the points; a sharp corner is
+                                     given twice with the normals of its two sides.
+    """
+    n = len(points)
+    z = np.linspace(bottom, top, segs_z + 1)
+    lengths = np.linalg.norm(np.diff(points, axis=0), axis=-1)
+    u = np.concatenate([[0], np.cumsum(lengths)]) / lengths.sum()
+
+    vertices = [np.concatenate([np.tile(points, (segs_z + 1, 1)), np.repeat(z, n)[:, None]], axis=-1)]
+    vertex_normals = [np.concatenate([np.tile(normals, (segs_z + 1, 1)), np.zeros((n * (segs_z + 1), 1))], axis=-1)]
+    texcoords = [np.stack([np.tile(u, segs_z + 1), np.repeat((z - bottom) / (top - bottom), n)], axis=-1)]
+
+    # the quads between the two points of a sharp corner have no area.
+    a = (np.arange(segs_z)[:, None] * n + np.flatnonzero(lengths > 1e-9)).ravel()
+    triangles = [np.stack([a, a + 1, a + n + 1, a, a + n + 1, a + n], axis=-1).reshape(-1, 3)]
+    count = n * (segs_z + 1)
+
+    outline = points[:-1][lengths > 1e-9]
+    m = len(outline)
+    rings = max(rings, 1)
+    scales = np.arange(1, rings + 1) / rings
+    cap = np.concatenate([[[0, 0]], (scales[:, None, None] * outline).reshape(-1, 2)])
+    size = np.maximum(outline.max(axis=0) - outline.min(axis=0), 1e-9)
+
+    # the fan around the center, then the quads between the rings.
+    i = np.arange(m)
+    fan = np.stack([np.zeros(m, dtype=int), 1 + i, 1 + (i + 1) % m], axis=-1)
+    inner = 1 + np.arange(rings - 1)[:, None] * m + i
+    outer = inner + m
+    inner_next = 1 + np.arange(rings - 1)[:, None] * m + (i + 1) % m
+    outer_next = inner_next + m
+    cap_triangles = np.concatenate([
+        fan,
+        np.stack([inner, outer, outer_next], axis=-1).reshape(-1, 3),
+        np.stack([inner, outer_next, inner_next], axis=-1).reshape(-1, 3)
+    ])
+
+    for height, sign, is_open in ((top, 1, open_top), (bottom, -1, open_bottom)):
+        if is_open:
+            continue
+
+        vertices.append(np.concatenate([cap, np.full((len(cap), 1), height)], axis=-1))
+        vertex_normals.append(np.tile([0, 0, sign], (len(cap), 1)))
+        texcoords.append((cap - outline.min(axis=0)) / size)
+        # the bottom cap faces downward.
+        triangles.append(count + (cap_triangles if sign > 0 else cap_triangles[:, ::-1]))
+        count += len(cap)
+
+    return (np.concatenate(vertices), np.concatenate(vertex_normals),
+            np.concatenate(texcoords), np.concatenate(triangles))
+
+
+def vertex_data_size(vdata):
+    return sum(vdata.get_array(i).get_data_size_bytes() for i in range(vdata.get_num_arrays()))
+
+
+def is_float(vdata, name):
+    return vdata.get_format().get_column(name).get_numeric_type() == GeomEnums.NT_float32
+
+
+def compact_format(color=False, texcoord=False):
+    """Returns the format of 16 bit integer positions and normals, optional 8 bit colors
+       and optional float texcoords, 12 to 24 bytes per vertex. The columns are packed without
+       the default 4 byte alignment, which would leave gaps that memoryview cannot cast.
+    """
+    array_format = GeomVertexArrayFormat()
+    array_format.add_column(InternalName.get_vertex(), 3, GeomEnums.NT_int16, GeomEnums.C_point, -1, 2)
+    array_format.add_column(InternalName.get_normal(), 3, GeomEnums.NT_int16, GeomEnums.C_normal, -1, 2)
+
+    if color:
+        array_format.add_column(InternalName.get_color(), 4, GeomEnums.NT_uint8, GeomEnums.C_color)
+
+    if texcoord:
+        array_format.add_column(InternalName.get_texcoord(), 2, GeomEnums.NT_float32, GeomEnums.C_texcoord)
+
+    return GeomVertexFormat.register_format(array_format)
+
+
+def compact_geom(geom, offset, scale, texcoord=False):
+    """Returns a copy of the Geom whose positions are stored as 16 bit integers
+       of (position - offset) / scale and normals as 16 bit integers, which the shaders
+       normalize. Colors are kept in 8 bits unless all white; texcoords are dropped
+       unless texcoord is True.
+    """
+    vdata = geom.get_vertex_data()
+    vertices = read_column(vdata, 'vertex')[:, :3]
+    colors = read_column(vdata, 'color') if vdata.has_column('color') else None
+    if colors is not None and np.all(colors > 254 / 255):
+        colors = None
+
+    texcoord = texcoord and vdata.has_column('texcoord')
+    compact = GeomVertexData(vdata.get_name(), compact_format(colors is not None, texcoord), Geom.UH_static)
+    compact.unclean_set_num_rows(len(vertices))
+    write_column(compact, 'vertex', np.round((vertices - offset) / scale))
+    write_column(compact, 'normal', np.round(read_column(vdata, 'normal')[:, :3] * 32767))
+
+    if colors is not None:
+        write_column(compact, 'color', colors)
+
+    if texcoord:
+        write_column(compact, 'texcoord', read_column(vdata, 'texcoord')[:, :2])
+
+    geom = geom.make_copy()
+    geom.set_vertex_data(compact)
+    return geom
+
+
+def compact_geom_nodes(geom_nps):
+    """Replaces the Geoms of the GeomNodes with compact_geom() copies, quantizing the positions
+       in the bounds of each node, which the transform of the node scales back.
+       Geoms shared by several nodes with the same bounds stay shared, and the ones
+       drawn with a texture, like the palette colors, keep their texcoords;
+       nodes with children or Geoms without normals are left as they are.
+       Returns the sizes of the vertex data before and after in bytes.
+    """
+    compacted = {}
+    before = after = 0
+
+    for geom_np in geom_nps:
+        node = geom_np.node()
+        geoms = [node.get_geom(i) for i in range(node.get_num_geoms())]
+
+        if not geoms or geom_np.get_num_children() or not all(
+                g.get_vertex_data().has_column('normal') and is_float(g.get_vertex_data(), 'vertex')
+                for g in geoms):
+            continue
+
+        textured = geom_np.get_net_state().has_attrib(TextureAttrib)
+        points = np.concatenate([read_column(g.get_vertex_data(), 'vertex')[:, :3] for g in geoms])
+        lower, upper = points.min(axis=0), points.max(axis=0)
+        offset = (lower + upper) / 2
+        scale = max((upper - lower).max() / 2, 1e-6) / 32767
+
+        for i, geom in enumerate(geoms):
+            texcoord = textured or node.get_geom_state(i).has_attrib(TextureAttrib)
+            # keyed by the address of the Geom, which is kept alive by the value
+            # so that the address is not reused after the node lets it go.
+            key = (geom.this, *offset.tolist(), scale, texcoord)
+
+            if (entry := compacted.get(key)) is None:
+                entry = compacted[key] = (geom, compact_geom(geom, offset, scale, texcoord))
+                before += vertex_data_size(geom.get_vertex_data())
+                after += vertex_data_size(entry[1].get_vertex_data())
+
+            compact = entry[1]
+
+            node.set_geom(i, compact)
+
+        geom_np.set_transform(geom_np.get_transform().compose(
+            TransformState.make_pos_hpr_scale(Point3(*offset), Vec3(0), Vec3(scale))))
+
+    return before, after
+
+
+def get_vertices(geom_node):
+    """Returns the positions of all vertices in the GeomNode."""
+    arrays = [read_column(geom_node.get_geom(i).get_vertex_data(), 'vertex')[:, :3]
+              for i in range(geom_node.get_num_geoms())]
+    return np.concatenate(arrays)
+
+
+def get_triangles(geom_node):
+    """Returns the triangles of all Geoms in the GeomNode as a (n, 3, 3) array of positions."""
+    triangles = []
+
+    for i in range(geom_node.get_num_geoms()):
+        geom = geom_node.get_geom(i).decompose()
+        vertices = read_column(geom.get_vertex_data(), 'vertex')[:, :3]
+
+        for prim in geom.get_primitives():
+            if prim.is_indexed():
+                dtype = NUMERIC_TYPES[prim.get_index_type()]
+                indices = np.frombuffer(memoryview(prim.get_vertices()).cast('B'), dtype=dtype)
+            else:
+                start = prim.get_first_vertex()
+                indices = np.arange(start, start + prim.get_num_vertices())
+
+            triangles.append(vertices[indices.reshape(-1, 3)])
+
+    return np.concatenate(triangles) if triangles else np.empty((0, 3, 3))
+
+
+def cluster_points(points, tolerance, max_points):
+    """Reduces points by merging the ones falling into the same cell of a grid,
+       whose size starts from tolerance and grows until at most max_points remain.
+    """
+    if not tolerance > 0:
+        raise ValueError(f'tolerance must be positive, not {tolerance}')
+    if max_points < 1:
+        raise ValueError(f'max_points must be at least 1, not {max_points}')
+
+    cell = tolerance
+
+    while True:
+        _, idx = np.unique(np.round(points / cell), axis=0, return_index=True)
+        if len(idx) <= max_points:
+            return points[np.sort(idx)]
+        cell *= 1.5
+
+
+def make_box(name, lower, upper):
+    """Returns a GeomNode of the box between the lower and upper corners."""
+    vdata = GeomVertexData(name, GeomVertexFormat.get_v3n3t2(), Geom.UH_static)
+    vdata.unclean_set_num_rows(24)
+    vertex = GeomVertexWriter(vdata, 'vertex')
+    normal = GeomVertexWriter(vdata, 'normal')
+    texcoord = GeomVertexWriter(vdata, 'texcoord')
+    prim = GeomTriangles(Geom.UH_static)
+
+    for axis in range(3):
+        for sign in (-1, 1):
+            n = [0, 0, 0]
+            n[axis] = sign
+            # the two other axes, ordered so that the faces wind counterclockwise.
+            u, v = [(1, 2), (2, 0), (0, 1)][axis]
+            if sign < 0:
+                u, v = v, u
+
+            start = vertex.get_write_row()
+            for du, dv in ((0, 0), (1, 0), (1, 1), (0, 1)):
+                pt = [0, 0, 0]
+                pt[axis] = upper[axis] if sign > 0 else lower[axis]
+                pt[u] = upper[u] if du else lower[u]
+                pt[v] = upper[v] if dv else lower[v]
+                vertex.set_data3(*pt)
+                normal.set_data3(*n)
+                texcoord.set_data2(du, dv)
+
+            prim.add_vertices(start, start + 1, start + 2)
+            prim.add_vertices(start, start + 2, start + 3)
+
+    geom = Geom(vdata)
+    geom.add_primitive(prim)
+    node = GeomNode(name)
+    node.add_geom(geom)
+    return node
@@ -0,0 +1,211 @@
+import math
+from collections import deque, OrderedDict
+
+import numpy as np
+from panda3d.bullet import BulletRigidBodyNode
+from panda3d.bullet import BulletTriangleMeshShape, BulletTriangleMesh
+from panda3d.core import NodePath, Thread, Texture, SamplerState
+from panda3d.core import BitMask32, Point3, TransformState
+
+from profiling import profiler
+from shapes.src import Plane
+
+
+class ImageRoads:
+    """Cuts the regions of the ground out of a grayscale image covering all of it,
+       sampled bilinearly, for a ground without a VoronoiCityGenerator.
+
+        Args:
+            path (str): the path of the image, e.g. a large image of the roads.
+            w (float): the width of the ground the image covers.
+            d (float): the depth of the ground the image covers.
+    """
+
+    def __init__(self, path, w, d):
+        tex = base.loader.load_texture(path)
+        self.width = w
+        self.depth = d
+        # the first row of the ram image is the bottom of the image.
+        image = np.frombuffer(tex.get_ram_image_as('G'), dtype=np.uint8)
+        self.image = image.reshape(tex.get_y_size(), tex.get_x_size()).astype(np.float32)
+
+    def road_image(self, x0, y0, x1, y1, width, height):
+        """Returns the region from (x0, y0) to (x1, y1) as a grayscale array
+           of height rows and width columns, whose first row is at y0.
+        """
+        rows, cols = self.image.shape
+        u = ((x0 + (np.arange(width) + 0.5) / width * (x1 - x0)) / self.width + 0.5) * cols - 0.5
+        v = ((y0 + (np.arange(height) + 0.5) / height * (y1 - y0)) / self.depth + 0.5) * rows - 0.5
+        u = np.clip(u, 0, cols - 1)
+        v = np.clip(v, 0, rows - 1)
+
+        c0 = np.minimum(u.astype(int), cols - 2)
+        r0 = np.minimum(v.astype(int), rows - 2)
+        fu = (u - c0)[None, :]
+        fv = (v - r0)[:, None]
+        img = self.image
+
+        top = img[r0][:, c0] * (1 - fu) + img[r0][:, c0 + 1] * fu
+        bottom = img[r0 + 1][:, c0] * (1 - fu) + img[r0 + 1][:, c0 + 1] * fu
+        return np.round(top * (1 - fv) + bottom * fv).astype(np.uint8)
+
+
+class ChunkedGround(NodePath):
+    """Splits the ground into square chunks, each drawn with its own road texture
+       and colliding through its own shape of the ground body. The texture of a chunk
+       is rendered at the resolution of its distance from the camera on a threaded
+       task chain, so that the roads stay sharp at street level on a large city,
+       while the far chunks keep the coarse textures rendered at startup.
+       The textures of the finer levels last used are kept for chunks coming back to them.
+
+        Args:
+            source: VoronoiCityGenerator or ImageRoads, whose road_image renders a region.
+            w (float): the width of the ground.
+            d (float): the depth of the ground.
+            chunk_size (float): the largest length of the sides of a chunk.
+            levels (tuple): (distance, size) pairs, nearest first; the textures of
+                            the chunks within distance are size x size texels.
+                            The last size is used beyond the last distance.
+            segs (int): the segments on each side of the plane of a chunk.
+            max_updates (int): the number of textures replaced per frame at most.
+            max_cached (int): the number of textures of the finer levels kept.
+    """
+
+    def __init__(self, source, w, d, chunk_size=64, levels=((100, 512), (250, 128), (float('inf'), 32)),
+                 segs=4, max_updates=2, max_cached=64):
+        super().__init__(BulletRigidBodyNode('ground'))
+        self.set_tag('category', 'ground')
+        self.node().set_mass(0)
+        self.set_collide_mask(BitMask32.bit(1))
+
+        self.source = source
+        self.levels = levels
+        self.max_updates = max_updates
+        self.max_cached = max_cached
+        self.cols = max(1, math.ceil(w / chunk_size))
+        self.rows = max(1, math.ceil(d / chunk_size))
+        self.chunk_w = w / self.cols
+        self.chunk_d = d / self.rows
+
+        # the chunks share one plane and one collision mesh.
+        plane = Plane(self.chunk_w, self.chunk_d, segs, segs).create()
+        mesh = BulletTriangleMesh()
+        mesh.add_geom(plane.node().get_geom(0))
+        shape = BulletTriangleMeshShape(mesh, dynamic=False)
+
+        self.chunks = []
+        self.coarse_textures = []
+        # {(chunk, level): texture} of the finer levels, the least recently used first
+        self.cached = OrderedDict()
+        self.pending = set()
+        self.finished = deque()
+        self.centers = np.array([
+            ((c + 0.5) * self.chunk_w - w / 2, (r + 0.5) * self.chunk_d - d / 2)
+            for r in range(self.rows) for c in range(self.cols)
+        ])
+
+        # the level of the texture of each chunk, starting from the coarsest.
+        self.chunk_levels = np.full(len(self.centers), len(levels) - 1)
+        self.distances = np.array([distance for distance, _ in levels])
+        coarse = self.render_coarse(w, d)
+        size = levels[-1][1]
+
+        for i, (x, y) in enumerate(self.centers.tolist()):
+            model = plane.copy_to(self)
+            model.set_pos(x, y, 0)
+            self.node().add_shape(shape, TransformState.make_pos(Point3(x, y, 0)))
+
+            r, c = divmod(i, self.cols)
+            tex = self.make_texture(coarse[r * size:(r + 1) * size, c * size:(c + 1) * size])
+            model.set_texture(tex)
+            self.coarse_textures.append(tex)
+            self.chunks.append(model)
+
+        if Thread.is_threading_supported():
+            self.task_chain = 'ground_chunks'
+            base.taskMgr.setupTaskChain(self.task_chain, numThreads=1, frameSync=False)
+        else:
+            self.task_chain = None
+
+    def render_coarse(self, w, d):
+        """Renders the coarsest textures of all chunks at once as one image."""
+        size = self.levels[-1][1]
+
+        with profiler.span('coarse ground', 'startup'):
+            return self.source.road_image(-w / 2, -d / 2, w / 2, d / 2, self.cols * size, self.rows * size)
+
+    def make_texture(self, image):
+        tex = Texture('ground_chunk')
+        tex.setup_2d_texture(image.shape[1], image.shape[0], Texture.T_unsigned_byte, Texture.F_luminance)
+        tex.set_ram_image(np.ascontiguousarray(image).tobytes())
+        # mipmaps and anisotropic filtering keep the roads sharp at grazing angles.
+        tex.set_minfilter(SamplerState.FT_linear_mipmap_linear)
+        tex.set_magfilter(SamplerState.FT_linear)
+        tex.set_anisotropic_degree(4)
+        tex.set_wrap_u(SamplerState.WM_clamp)
+        tex.set_wrap_v(SamplerState.WM_clamp)
+        return tex
+
+    def start(self):
+        base.taskMgr.add(self.update, 'update_ground')
+
+    def get_focus(self):
+        return base.camera.get_pos(self)
+
+    def update(self, task):
+        focus = self.get_focus()
+        # the distance from the camera to the nearest point of each chunk.
+        offset = np.maximum(
+            np.abs(self.centers - [focus.x, focus.y]) - [self.chunk_w / 2, self.chunk_d / 2], 0)
+        dist = np.hypot(np.linalg.norm(offset, axis=-1), max(focus.z, 0))
+        levels = np.minimum(np.searchsorted(self.distances, dist), len(self.levels) - 1)
+        changed = np.flatnonzero(levels != self.chunk_levels)
+
+        # the nearest chunks are rendered first.
+        for i in changed[np.argsort(dist[changed])].tolist():
+            level = int(levels[i])
+
+            if (tex := self.get_texture(i, level)) is not None:
+                self.chunks[i].set_texture(tex)
+                self.chunk_levels[i] = level
+            elif i not in self.pending:
+                self.pending.add(i)
+                base.taskMgr.add(self.render_chunk, f'render_ground_{i}',
+                                 extraArgs=[i, level], taskChain=self.task_chain)
+
+        for _ in range(min(self.max_updates, len(self.finished))):
+            i, level, image = self.finished.popleft()
+            self.pending.discard(i)
+            tex = self.make_texture(image)
+            self.cache_texture(i, level, tex)
+            self.chunks[i].set_texture(tex)
+            self.chunk_levels[i] = level
+
+        return task.cont
+
+    def get_texture(self, i, level):
+        """Returns the texture of the chunk at the level if it is kept, or None."""
+        if level == len(self.levels) - 1:
+            return self.coarse_textures[i]
+
+        if (tex := self.cached.get((i, level))) is not None:
+            self.cached.move_to_end((i, level))
+
+        return tex
+
+    def cache_texture(self, i, level, tex):
+        self.cached[(i, level)] = tex
+        self.cached.move_to_end((i, level))
+
+        while len(self.cached) > self.max_cached:
+            self.cached.popitem(last=False)
+
+    def render_chunk(self, i, level):
+        x, y = self.centers[i]
+        w, d = self.chunk_w / 2, self.chunk_d / 2
+        size = self.levels[level][1]
+
+        with profiler.span('ground chunk', 'ground'):
+            image = self.source.road_image(x - w, y - d, x + w, y + d, size, size)
+
+        self.finished.append((i, level, image))
@@ -0,0 +1,312 @@
+"""Declarative city layouts: the buildings, their pieces and the trees of a city
+   stored as JSON arrays instead of Python code.
+
+    python layouts.py city_layout.json
+    python layouts.py city_layout.json --procedural 16 16 --seed 1
+
+A layout is made by running the builds of the areas, or of a VoronoiCityGenerator,
+without generating any geometry and recording what they place. Setting LAYOUT
+in voronoi_city.py to the file then builds the city from it without running the
+stack recipes. Layout format, version 1:
+
+    makers:    [{"type": "MaterialCylinder", "params": {...}, "convex": true}, ...]
+    areas:     names of the groups the buildings and trees are culled by
+    buildings: {"name": [...], "area": [...], "pos": [[x, y, z]], "hpr": [[h, p, r]],
+                "color": [[r, g, b]]}
+    pieces:    {"building": [...], "maker": [...], "pos": [[x, y, z]], "hpr": [[h, p, r]]}
+    trees:     {"area": [...], "pos": [[x, y]]}
+
+The segment counts of the makers are recorded, so TESSELLATION does not apply
+to layouts; VECTORIZED_MESHES does.
+"""
+import argparse
+import hashlib
+import inspect
+import json
+import math
+
+import numpy as np
+from panda3d.core import NodePath, TransformState
+from panda3d.core import Point3, Vec3, LColor
+
+import building_materials
+from caches import geom_cache
+from city import City, Building
+
+
+LAYOUT_VERSION = 1
+
+
+class LayoutCity(City, register=False):
+    """Builds one area of a layout.
+
+        Args:
+            name (str): the name of the area, used as the name of its group.
+            buildings (list): (name, pos, hpr, color, pieces) of each building,
+                              pieces being (maker, TransformState) pairs.
+            trees (list): (x, y) of each tree.
+    """
+
+    def __init__(self, name, buildings, trees, root=None):
+        super().__init__(root)
+        self.name = name
+        self.building_specs = buildings
+        self.tree_positions = trees
+
+    def get_group_name(self, model):
+        return self.name
+
+    def build(self):
+        for name, pos, hpr, color, pieces in self.building_specs:
+            building = Building(name, pos, hpr)
+            building.set_color(color)
+
+            for maker, transform in pieces:
+                building.add_piece(maker, transform)
+
+            self.attach(building)
+
+        if self.tree_positions:
+            self.plant_trees(*self.tree_positions)
+
+
+def get_array(data, section, name, dtype, columns=None):
+    try:
+        # indices are read as floats first, which int would truncate.
+        values = np.asarray(data[section][name], dtype=float)
+    except KeyError as e:
+        raise ValueError(f'Missing layout field: {section}.{name}') from e
+    except (TypeError, ValueError) as e:
+        raise ValueError(f'Invalid layout field: {section}.{name}') from e
+
+    if columns is None:
+        values = values.reshape(-1)
+    elif values.size == 0:
+        values = values.reshape(0, columns)
+    elif values.ndim != 2 or values.shape[1] != columns:
+        raise ValueError(f'{section}.{name} must be a list of {columns} numbers each')
+
+    if not np.isfinite(values).all():
+        raise ValueError(f'{section}.{name} has values that are not finite')
+
+    if dtype is int:
+        if (values != np.round(values)).any():
+            raise ValueError(f'{section}.{name} has values that are not integers')
+        values = values.astype(int)
+
+    return values
+
+
+def get_section(data, section, kind=dict):
+    values = data.get(section, kind())
+    if not isinstance(values, kind):
+        raise ValueError(f'{section} must be a {"list" if kind is list else "dict"}')
+
+    return values
+
+
+def validate_maker(i, spec):
+    """Checks a maker spec and returns (class, params, convex) of it."""
+    if not isinstance(spec, dict):
+        raise ValueError(f'makers[{i}] must be a dict')
+
+    cls = getattr(building_materials, str(spec.get('type')), None)
+    if not (isinstance(cls, type) and issubclass(cls, building_materials.Material)
+            and cls is not building_materials.Material):
+        raise ValueError(f"Unknown maker: makers[{i}] {spec.get('type')}")
+
+    params = spec.get('params', {})
+    if not isinstance(params, dict):
+        raise ValueError(f'makers[{i}].params must be a dict')
+
+    for name, value in params.items():
+        if not (isinstance(value, bool)
+                or isinstance(value, (int, float)) and math.isfinite(value)):
+            raise ValueError(f'makers[{i}].params.{name} must be a finite number or a bool')
+
+    # the params are the arguments of the shapes maker that the material extends.
+    shape_cls = cls.__mro__[cls.__mro__.index(building_materials.Material) + 1]
+    try:
+        inspect.signature(shape_cls.__init__).bind(None, **params)
+    except TypeError as e:
+        raise ValueError(f'makers[{i}].params do not fit {shape_cls.__name__}: {e}') from e
+
+    return cls, dict(params), bool(spec.get('convex', True))
+
+
+def check_indices(indices, size, field):
+    if len(indices) and (indices.min() < 0 or indices.max() >= size):
+        raise ValueError(f'{field} has indices out of range')
+
+
+def validate(data):
+    """Checks the layout and returns its fields as arrays; raises ValueError if it is invalid."""
+    if not isinstance(data, dict) or data.get('version') != LAYOUT_VERSION:
+        raise ValueError(f'Layout version must be {LAYOUT_VERSION}')
+
+    makers = [validate_maker(i, spec) for i, spec in enumerate(get_section(data, 'makers', list))]
+    areas = get_section(data, 'areas', list)
+    if not all(isinstance(name, str) for name in areas):
+        raise ValueError('areas must be a list of strings')
+
+    for section in ('buildings', 'pieces', 'trees'):
+        get_section(data, section)
+
+    names = get_section(data, 'buildings').get('name', [])
+    if not isinstance(names, list):
+        raise ValueError('buildings.name must be a list')
+
+    fields = dict(
+        building_names=[str(name) for name in names],
+        building_areas=get_array(data, 'buildings', 'area', int),
+        building_pos=get_array(data, 'buildings', 'pos', float, 3),
+        building_hpr=get_array(data, 'buildings', 'hpr', float, 3),
+        building_colors=get_array(data, 'buildings', 'color', float, 3),
+        piece_buildings=get_array(data, 'pieces', 'building', int),
+        piece_makers=get_array(data, 'pieces', 'maker', int),
+        piece_pos=get_array(data, 'pieces', 'pos', float, 3),
+        piece_hpr=get_array(data, 'pieces', 'hpr', float, 3),
+        tree_areas=get_array(data, 'trees', 'area', int),
+        tree_pos=get_array(data, 'trees', 'pos', float, 2),
+    )
+
+    for prefix in ('building', 'piece', 'tree'):
+        lengths = {len(values) for name, values in fields.items() if name.startswith(prefix)}
+        if len(lengths) > 1:
+            raise ValueError(f'The fields of the {prefix}s have different lengths')
+
+    check_indices(fields['building_areas'], len(areas), 'buildings.area')
+    check_indices(fields['tree_areas'], len(areas), 'trees.area')
+    check_indices(fields['piece_buildings'], len(fields['building_names']), 'pieces.building')
+    check_indices(fields['piece_makers'], len(makers), 'pieces.maker')
+
+    return makers, areas, fields
+
+
+def load_layout(path):
+    """Reads and validates a layout file and returns a LayoutCity for each of its areas."""
+    with open(path) as f:
+        makers, areas, fields = validate(json.load(f))
+
+    # each maker of the layout is made only once.
+    vectorized = building_materials.default_vectorized
+    maker_objects = []
+
+    for cls, params, convex in makers:
+        maker = cls.from_params(vectorized, **params)
+        maker.is_convex = convex
+        maker_objects.append(maker)
+
+    pieces = [[] for _ in fields['building_names']]
+    for b, m, pos, hpr in zip(fields['piece_buildings'].tolist(), fields['piece_makers'].tolist(),
+                              fields['piece_pos'].tolist(), fields['piece_hpr'].tolist()):
+        pieces[b].append((maker_objects[m], TransformState.make_pos_hpr(Vec3(*pos), Vec3(*hpr))))
+
+    buildings = [[] for _ in areas]
+    for i, (name, area, pos, hpr, color) in enumerate(zip(
+            fields['building_names'], fields['building_areas'].tolist(), fields['building_pos'].tolist(),
+            fields['building_hpr'].tolist(), fields['building_colors'].tolist())):
+        buildings[area].append((name, Point3(*pos), Vec3(*hpr), LColor(*color, 1), pieces[i]))
+
+    trees = [[] for _ in areas]
+    for area, pos in zip(fields['tree_areas'].tolist(), fields['tree_pos'].tolist()):
+        trees[area].append(pos)
+
+    return [LayoutCity(name, buildings[i], trees[i]) for i, name in enumerate(areas)]
+
+
+def layout_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+def round_list(values, digits=4):
+    return [round(v, digits) + 0. for v in values]
+
+
+def export_layout(area_builders, path):
+    """Runs the builds of the area builders without generating geometry,
+       and writes what they place into a layout file.
+    """
+    makers = []
+    maker_indices = {}
+    areas = {}
+    buildings = dict(name=[], area=[], pos=[], hpr=[], color=[])
+    pieces = dict(building=[], maker=[], pos=[], hpr=[])
+    trees = dict(area=[], pos=[])
+
+    for area_builder in area_builders:
+        builder = area_builder.detached(NodePath('export'))
+
+        with geom_cache.plan():
+            builder.build()
+            builder.assign_colors()
+
+        for name, group in builder.groups.items():
+            area = areas.setdefault(name, len(areas))
+
+            for tree in group.find_all_matches('=category=tree'):
+                trees['area'].append(area)
+                trees['pos'].append(round_list(tree.get_pos().xy))
+
+        for building in builder.buildings:
+            index = len(buildings['name'])
+            buildings['name'].append(building.get_name().removeprefix('building_'))
+            buildings['area'].append(areas[building.get_parent().get_name()])
+            buildings['pos'].append(round_list(building.get_pos()))
+            buildings['hpr'].append(round_list(building.get_hpr()))
+            buildings['color'].append(round_list(building.get_color().xyz))
+
+            for maker, transform in building.pieces:
+                key = (maker.key, maker.is_convex)
+                if (maker_index := maker_indices.get(key)) is None:
+                    maker_index = maker_indices[key] = len(makers)
+                    makers.append(dict(type=maker.__class__.__name__, params=maker.params,
+                                       convex=maker.is_convex))
+
+                pieces['building'].append(index)
+                pieces['maker'].append(maker_index)
+                pieces['pos'].append(round_list(transform.get_pos()))
+                pieces['hpr'].append(round_list(transform.get_hpr()))
+
+    data = dict(
+        version=LAYOUT_VERSION,
+        makers=makers,
+        areas=list(areas),
+        buildings=buildings,
+        pieces=pieces,
+        trees=trees
+    )
+    with open(path, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='the layout file to write')
+    parser.add_argument('--procedural', type=int, nargs=2, metavar=('CELLS_X', 'CELLS_Y'),
+                        help='export a VoronoiCityGenerator city instead of the hand-authored areas')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    from panda3d.core import load_prc_file_data
+    load_prc_file_data('', 'window-type none\naudio-library-name null')
+    from direct.showbase.ShowBase import ShowBase
+    ShowBase()
+
+    if args.procedural:
+        from procedural import VoronoiCityGenerator
+        cells_x, cells_y = args.procedural
+        area_builders = [VoronoiCityGenerator(cells_x, cells_y, seed=args.seed)]
+    else:
+        area_builders = City.create_areas(args.seed)
+
+    data = export_layout(area_builders, args.path)
+    print(f"{args.path}: {len(data['buildings']['name'])} buildings, {len(data['pieces']['maker'])} pieces, "
+          f"{len(data['makers'])} makers, {len(data['trees']['pos'])} trees")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+import numpy as np
+from panda3d.core import ColorAttrib, GeomVertexData
+
+from geom_utils import read_column, write_column, with_color_column
+from picking import Picker
+
+
+def hemisphere_directions(samples):
+    """Returns cosine weighted directions around +z spread by the golden angle."""
+    i = np.arange(samples) + 0.5
+    r = np.sqrt(i / samples)
+    angle = i * np.pi * (3 - np.sqrt(5))
+    return np.stack([r * np.cos(angle), r * np.sin(angle), np.sqrt(1 - r ** 2)], axis=-1)
+
+
+def tangent_frames(normals):
+    """Returns two unit vectors perpendicular to each normal and to each other."""
+    helper = np.where(np.abs(normals[:, 2:3]) < 0.9, [[0, 0, 1]], [[1, 0, 0]])
+    tangents = np.cross(helper, normals)
+    tangents /= np.linalg.norm(tangents, axis=-1, keepdims=True)
+    return tangents, np.cross(normals, tangents)
+
+
+class LightBaker:
+    """Bakes ambient occlusion and the visibility of the sun into the vertex colors
+       of the buildings, casting rays against the bounding boxes of their pieces and the ground.
+       The baked geometry is drawn without lights and shaders, and is tagged
+       so that restore() can turn the shaders off again after it is loaded from a bake.
+
+        Args:
+            samples (int): the number of rays per vertex for ambient occlusion.
+            ao_distance (float): occluders farther than this do not darken a vertex.
+            ao_strength (float): how much the ambient light is reduced by full occlusion.
+            sun_distance (float): the length of the rays toward the sun.
+            max_tests (int): the number of ray and box tests made at once.
+    """
+
+    def __init__(self, samples=16, ao_distance=20, ao_strength=0.8, sun_distance=300,
+                 max_tests=4_000_000):
+        self.samples = samples
+        self.ao_distance = ao_distance
+        self.ao_strength = ao_strength
+        self.sun_distance = sun_distance
+        self.max_tests = max_tests
+        self.directions = hemisphere_directions(samples)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.samples!r}, {self.ao_distance!r}, '
+                f'{self.ao_strength!r}, {self.sun_distance!r})')
+
+    def bake(self, city_root, buildings, ambient_light, day_light):
+        picker = Picker()
+        picker.build(buildings)
+        self.lower = picker.bvh.lower
+        self.upper = picker.bvh.upper
+        self.bvh = picker.bvh
+
+        self.ambient = np.array(ambient_light.node().get_color())[:3]
+        self.sun = np.array(day_light.node().get_color())[:3]
+        self.to_sun = -np.array(day_light.get_quat(base.render).get_forward())
+
+        # trees are textured and keep the real-time lights.
+        for geom_np in city_root.find_all_matches('**/+GeomNode'):
+            if geom_np.get_net_tag('category') != 'tree':
+                self.bake_geom_node(geom_np)
+
+    def bake_geom_node(self, geom_np):
+        mat = np.array(geom_np.get_net_transform().get_mat())
+        net_color = geom_np.get_net_state().get_attrib(ColorAttrib)
+        node = geom_np.node()
+
+        for i in range(node.get_num_geoms()):
+            geom = node.modify_geom(i)
+            if not geom.get_vertex_data().has_column('normal'):
+                continue
+
+            # the vertex data may be shared with the other copies of the cached geometry.
+            vdata = with_color_column(GeomVertexData(geom.get_vertex_data()))
+            vertices = read_column(vdata, 'vertex')[:, :3]
+            normals = read_column(vdata, 'normal')[:, :3]
+            # flatten leaves the color of a building in the state of its Geoms.
+            if (attrib := node.get_geom_state(i).get_attrib(ColorAttrib)) is None:
+                attrib = net_color
+
+            if attrib and attrib.get_color_type() == ColorAttrib.T_flat:
+                colors = np.array([attrib.get_color()])
+            else:
+                colors = read_column(vdata, 'color')
+
+            points = vertices @ mat[:3, :3] + mat[3, :3]
+            normals = normals @ mat[:3, :3]
+            normals /= np.maximum(np.linalg.norm(normals, axis=-1, keepdims=True), 1e-9)
+
+            light = self.ambient * (1 - self.ao_strength * self.occlusion(points, normals))[:, None]
+            lambert = np.maximum(normals @ self.to_sun, 0)
+            light += self.sun * (lambert * self.sun_visibility(points, normals, lambert))[:, None]
+
+            colors = np.broadcast_to(colors, (len(points), 4)).copy()
+            colors[:, :3] = np.clip(colors[:, :3] * light, 0, 1)
+            write_column(vdata, 'color', colors)
+            geom.set_vertex_data(vdata)
+            node.set_geom_state(i, node.get_geom_state(i).remove_attrib(ColorAttrib))
+
+        # the baked vertex colors replace the flat color, the lights and the auto shader.
+        geom_np.set_color_off(1)
+        geom_np.set_light_off(1)
+        geom_np.set_shader_off(1)
+        geom_np.set_tag('baked_lighting', '1')
+
+    def restore(self, city_root):
+        """Turns the shaders off again on the baked geometry loaded from a bam file,
+           which cannot store shader attribs.
+        """
+        for geom_np in city_root.find_all_matches('**/=baked_lighting'):
+            geom_np.set_shader_off(1)
+
+    def occluded(self, origins, directions, distance, chunk=4096):
+        """Returns whether each ray hits the ground or a box within distance.
+           Boxes containing the origin, like the one of its own piece, are ignored.
+           The rays are tested in chunks of nearby origins against the boxes around them.
+        """
+        with np.errstate(divide='ignore'):
+            ground = np.where(directions[:, 2] < 0, origins[:, 2] / -directions[:, 2], np.inf)
+        hit = ground <= distance
+
+        origins = origins.astype(np.float32)
+        inv_dirs = (1 / np.where(directions == 0, 1e-12, directions)).astype(np.float32)
+        cells = np.floor(origins[:, :2] / max(distance, 1)).astype(int)
+        order = np.lexsort((cells[:, 1], cells[:, 0]))
+
+        for start in range(0, len(order), chunk):
+            idx = order[start:start + chunk]
+            reach = directions[idx] * distance
+            boxes = self.bvh.intersect_box(origins[idx].min(axis=0) + np.minimum(reach.min(axis=0), 0),
+                                           origins[idx].max(axis=0) + np.maximum(reach.max(axis=0), 0))
+            if not len(boxes):
+                continue
+
+            lower = self.lower[boxes].T.astype(np.float32)
+            upper = self.upper[boxes].T.astype(np.float32)
+            step = max(1, self.max_tests // len(boxes))
+
+            for sub in range(0, len(idx), step):
+                i = idx[sub:sub + step]
+                t_near = np.zeros((len(i), len(boxes)), dtype=np.float32) - np.inf
+                t_far = np.zeros_like(t_near) + np.inf
+
+                # slab test by axis, (rays, boxes) at a time
+                for axis in range(3):
+                    o = origins[i, axis, None]
+                    inv = inv_dirs[i, axis, None]
+                    t1 = (lower[axis] - o) * inv
+                    t2 = (upper[axis] - o) * inv
+                    np.maximum(t_near, np.minimum(t1, t2), out=t_near)
+                    np.minimum(t_far, np.maximum(t1, t2), out=t_far)
+
+                # t_near is negative if the origin is in the box.
+                hit[i] |= ((t_near > 0) & (t_near <= t_far) & (t_near <= distance)).any(axis=-1)
+
+        return hit
+
+    def occlusion(self, points, normals):
+        """Returns the fraction of the hemisphere around each normal that is occluded."""
+        tangents, bitangents = tangent_frames(normals)
+        origins = points + normals * 0.05
+        d = self.directions
+        # (vertices, samples, 3) directions around the normals
+        directions = (tangents[:, None] * d[:, 0, None] + bitangents[:, None] * d[:, 1, None]
+                      + normals[:, None] * d[:, 2, None])
+
+        hit = self.occluded(
+            np.repeat(origins, self.samples, axis=0), directions.reshape(-1, 3), self.ao_distance)
+        return hit.reshape(-1, self.samples).mean(axis=-1)
+
+    def sun_visibility(self, points, normals, lambert):
+        """Returns 1 for the vertices that see the sun and 0 for the ones in shadow."""
+        visibility = np.zeros(len(points))
+        lit = lambert > 0
+
+        if lit.any():
+            origins = points[lit] + normals[lit] * 0.05
+            directions = np.broadcast_to(self.to_sun, origins.shape)
+            visibility[lit] = ~self.occluded(origins, directions, self.sun_distance)
+
+        return visibility
@@ -1,3 +1,5 @@
+import math
+
 from panda3d.core import AmbientLight, DirectionalLight
 from panda3d.core import NodePath, PandaNode
 from panda3d.core import Vec3, Point3
@@ -14,15 +16,18 @@ class BasicAmbientLight(NodePath):
 
 class BasicDayLight(NodePath):
 
-    def __init__(self):
+    # the size of the shadow map of each quality tier; 'off' casts no shadows.
+    shadow_sizes = dict(off=0, low=1024, medium=2048, high=4096, ultra=8192)
+
+    def __init__(self, shadow_quality='ultra'):
         super().__init__(DirectionalLight('directional_light'))
         self.node().get_lens().set_film_size(200, 200)
         self.node().get_lens().set_near_far(10, 200)
         self.node().set_color((1, 1, 1, 1))
         self.set_pos_hpr(Point3(0, 0, 300), Vec3(-45, -45, 0))
 
-        self.node().set_shadow_caster(True, 8192, 8192)
-        # self.node().set_shadow_caster(True, 4096, 4096)
+        if size := self.shadow_sizes[shadow_quality]:
+            self.node().set_shadow_caster(True, size, size)
 
         state = self.node().get_initial_state()
         temp = NodePath(PandaNode('temp_np'))
@@ -34,4 +39,119 @@ class BasicDayLight(NodePath):
         base.render.set_light(self)
         base.render.set_shader_auto()
         self.reparent_to(base.render)
-        # self.node().show_frustum()
\ No newline at end of file
+        # self.node().show_frustum()
+
+
+class ShadowController:
+    """Keeps the shadow map of a DirectionalLight small and cheap.
+
+        Args:
+            light (NodePath): the light casting shadows.
+            fit_distance (float): if given, the film of the light is fitted every frame
+                                  to the view of the camera up to this distance.
+            cached (bool): if True, the shadow map is rendered only after the film
+                           or the light moves or invalidate() is called,
+                           instead of every frame.
+            margin (float): the depth in front of the view kept for the casters
+                            above it, like tall buildings.
+
+       The shader generator supports one shadow map per light, so the view is
+       covered by one fitted map; cascaded shadow maps need custom shaders.
+    """
+
+    def __init__(self, light, fit_distance=None, cached=False, margin=200):
+        self.light = light
+        self.fit_distance = fit_distance
+        self.cached = cached
+        self.margin = margin
+
+        self.frame = base.render.attach_new_node('shadow_frame')
+        self.film = None
+        self.quat = None
+        self.buffer = None
+        self.dirty = True
+
+    def start(self):
+        base.taskMgr.add(self.update, 'update_shadows')
+
+    def invalidate(self):
+        """Renders the shadow map again, e.g. after static geometry changed."""
+        self.dirty = True
+
+    def find_buffer(self):
+        """Returns the buffer rendering the shadow map, which is made
+           by the graphics engine when the light is first rendered.
+        """
+        engine = base.graphicsEngine
+
+        for i in range(engine.get_num_windows()):
+            if (buffer := engine.get_window(i)).get_name() == self.light.get_name():
+                return buffer
+
+    def get_view_points(self):
+        """Returns the corners of the view of the camera up to fit_distance."""
+        lens = base.camLens
+        distance = min(self.fit_distance, lens.get_far())
+        points = []
+
+        for corner in ((-1, -1), (-1, 1), (1, -1), (1, 1)):
+            near_pos = Point3()
+            far_pos = Point3()
+            lens.extrude(corner, near_pos, far_pos)
+            t = (distance - near_pos.y) / (far_pos.y - near_pos.y)
+
+            for pos in (near_pos, near_pos + (far_pos - near_pos) * t):
+                points.append(self.frame.get_relative_point(base.cam, pos))
+
+        return points
+
+    def fit(self):
+        """Moves the light and sets its film to cover the view of the camera.
+           Film size and center are snapped to steps of the shadow map's texels
+           so that the shadows do not shimmer while the camera moves;
+           returns True if the film changed.
+        """
+        self.frame.set_quat(self.light.get_quat(base.render))
+        points = self.get_view_points()
+        xs = [p.x for p in points]
+        ys = [p.y for p in points]
+        zs = [p.z for p in points]
+
+        step = self.fit_distance / 8
+        size = math.ceil(max(max(xs) - min(xs), max(zs) - min(zs)) / step) * step
+        texel = size / self.light.node().get_shadow_buffer_size().x
+        cx = round((max(xs) + min(xs)) / 2 / texel) * texel
+        cz = round((max(zs) + min(zs)) / 2 / texel) * texel
+        near_y = min(ys) - self.margin
+        depth = max(ys) - near_y
+
+        film = (size, cx, cz, round(near_y / step), round(depth / step))
+        if film == self.film:
+            return False
+
+        self.film = film
+        self.light.set_pos(base.render, base.render.get_relative_point(self.frame, Point3(cx, near_y, cz)))
+        lens = self.light.node().get_lens()
+        lens.set_film_size(size, size)
+        lens.set_near_far(1, depth + step + 1)
+        return True
+
+    def update(self, task):
+        if (quat := self.light.get_quat(base.render)) != self.quat:
+            self.quat = quat
+            self.dirty = True
+
+        if self.fit_distance and self.fit():
+            self.dirty = True
+
+        if self.cached:
+            if self.buffer is None:
+                self.buffer = self.find_buffer()
+
+            if self.buffer is not None and self.dirty:
+                # renders the next frame once, then the buffer turns itself inactive.
+                self.buffer.set_active(True)
+                self.buffer.set_one_shot(True)
+                self.dirty = False
+
+        return task.cont
@@ -0,0 +1,248 @@
+from collections import namedtuple
+
+import numpy as np
+from panda3d.core import NodePath, Point3
+
+from caches import geom_cache
+from geom_utils import get_triangles
+
+
+PickResult = namedtuple('PickResult', 'building piece hit_pos')
+
+
+def ray_box_test(lower, upper, origin, inv_dir):
+    """Slab test of a ray against boxes; returns the mask of the boxes hit
+       and the ray parameters where the ray enters them.
+    """
+    t1 = (lower - origin) * inv_dir
+    t2 = (upper - origin) * inv_dir
+    t_near = np.maximum(np.minimum(t1, t2).max(axis=-1), 0)
+    t_far = np.maximum(t1, t2).min(axis=-1)
+    return t_near <= t_far, t_near
+
+
+def ray_triangle_test(triangles, origin, direction):
+    """Moller-Trumbore test of a ray against (n, 3, 3) triangles;
+       returns the smallest ray parameter of the hits or None.
+    """
+    v0, v1, v2 = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    e1 = v1 - v0
+    e2 = v2 - v0
+    p = np.cross(direction, e2)
+    det = (e1 * p).sum(axis=-1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv_det = 1 / det
+        s = origin - v0
+        u = (s * p).sum(axis=-1) * inv_det
+        q = np.cross(s, e1)
+        v = (q * direction).sum(axis=-1) * inv_det
+        t = (q * e2).sum(axis=-1) * inv_det
+
+    hit = (np.abs(det) > 1e-12) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t >= 0)
+    return t[hit].min() if hit.any() else None
+
+
+class BVH:
+    """Bounding volume hierarchy over axis aligned boxes, split at the median
+       of the box centers along the longest axis. Queries walk the tree level by level,
+       testing all the nodes of a level at once.
+    """
+
+    def __init__(self, lower, upper, leaf_size=4):
+        self.leaf_size = leaf_size
+        self.order = np.arange(len(lower))
+        self.node_lower = []
+        self.node_upper = []
+        self.children = []
+        self.ranges = []
+
+        if len(lower):
+            self.split(lower, upper, 0, len(lower))
+
+        self.node_lower = np.array(self.node_lower).reshape(-1, 3)
+        self.node_upper = np.array(self.node_upper).reshape(-1, 3)
+        self.children = np.array(self.children, dtype=int).reshape(-1, 2)
+        self.lower = lower
+        self.upper = upper
+
+    def split(self, lower, upper, start, end):
+        idx = self.order[start:end]
+        node = len(self.children)
+        self.node_lower.append(lower[idx].min(axis=0))
+        self.node_upper.append(upper[idx].max(axis=0))
+        self.children.append([-1, -1])
+        self.ranges.append((start, end))
+
+        if end - start > self.leaf_size:
+            centers = lower[idx] + upper[idx]
+            axis = np.argmax(centers.max(axis=0) - centers.min(axis=0))
+            mid = (end - start) // 2
+            self.order[start:end] = idx[np.argpartition(centers[:, axis], mid)]
+            self.children[node] = [self.split(lower, upper, start, start + mid),
+                                   self.split(lower, upper, start + mid, end)]
+
+        return node
+
+    def query(self, test):
+        """Returns the indices of the boxes that test(lower, upper) accepts."""
+        found = []
+        nodes = np.zeros(1, dtype=int) if len(self.children) else np.zeros(0, dtype=int)
+
+        while len(nodes):
+            nodes = nodes[test(self.node_lower[nodes], self.node_upper[nodes])]
+            leaf = self.children[nodes, 0] < 0
+
+            for node in nodes[leaf]:
+                start, end = self.ranges[node]
+                found.append(self.order[start:end])
+
+            nodes = self.children[nodes[~leaf]].ravel()
+
+        if not found:
+            return np.zeros(0, dtype=int)
+
+        idx = np.concatenate(found)
+        return idx[test(self.lower[idx], self.upper[idx])]
+
+    def intersect_ray(self, origin, direction):
+        """Returns the indices of the boxes hit by the ray and the ray parameters
+           where it enters them, nearest first.
+        """
+        with np.errstate(divide='ignore'):
+            inv_dir = 1 / np.where(direction == 0, 1e-12, direction)
+
+        idx = self.query(lambda lower, upper: ray_box_test(lower, upper, origin, inv_dir)[0])
+        _, t_near = ray_box_test(self.lower[idx], self.upper[idx], origin, inv_dir)
+        order = np.argsort(t_near)
+        return idx[order], t_near[order]
+
+    def intersect_box(self, lower, upper):
+        """Returns the indices of the boxes overlapping the box between lower and upper."""
+        return self.query(
+            lambda lo, up: np.all((lo <= upper) & (up >= lower), axis=-1))
+
+
+class Picker:
+    """Picks buildings with a BVH over the world space bounding boxes of their pieces
+       instead of Bullet ray tests. Buildings that do not record their pieces,
+       like the ones loaded from a bake, are picked by their own bounding boxes.
+
+        Args:
+            exact (bool): if True, the hits on the boxes are refined
+                          by the triangles of the pieces.
+            leaf_size (int): the number of boxes in a leaf of the BVH.
+    """
+
+    def __init__(self, exact=False, leaf_size=4):
+        self.exact = exact
+        self.leaf_size = leaf_size
+        self.triangles = {}
+        self.build([])
+
+    def build(self, buildings):
+        self.buildings = []
+        self.pieces = []
+        # one item per piece: (index of the building, index of the piece or None)
+        self.items = []
+        self.inv_mats = []
+        lower = []
+        upper = []
+
+        for building in buildings:
+            pieces = getattr(building, 'pieces', None) or []
+            net = building.get_net_transform()
+            index = len(self.buildings)
+            self.buildings.append(NodePath(building.node()))
+            self.pieces.append(pieces)
+
+            for i, (maker, transform) in enumerate(pieces):
+                if (model := geom_cache.models.get(maker.key)) is None:
+                    continue
+
+                piece_transform = net.compose(transform)
+                lo, up = model.get_tight_bounds()
+                corners = np.array([[x, y, z, 1] for x in (lo.x, up.x)
+                                    for y in (lo.y, up.y) for z in (lo.z, up.z)])
+                corners = corners @ np.array(piece_transform.get_mat())
+                lower.append(corners[:, :3].min(axis=0))
+                upper.append(corners[:, :3].max(axis=0))
+                self.items.append((index, i))
+                self.inv_mats.append(np.array(piece_transform.get_inverse().get_mat()))
+
+            if not pieces and (bounds := building.get_tight_bounds(base.render)):
+                lower.append(np.array(bounds[0]))
+                upper.append(np.array(bounds[1]))
+                self.items.append((index, None))
+                self.inv_mats.append(None)
+
+        self.bvh = BVH(np.array(lower).reshape(-1, 3), np.array(upper).reshape(-1, 3),
+                       self.leaf_size)
+
+    def get_triangles(self, maker):
+        if (triangles := self.triangles.get(maker.key)) is None:
+            triangles = get_triangles(geom_cache.models[maker.key].node())
+            self.triangles[maker.key] = triangles
+
+        return triangles
+
+    def refine(self, item, origin, direction):
+        """Returns the ray parameter where the ray hits the triangles of the piece."""
+        index, piece = self.items[item]
+        if piece is None:
+            return None
+
+        maker, _ = self.pieces[index][piece]
+        inv_mat = self.inv_mats[item]
+        local_origin = (np.append(origin, 1) @ inv_mat)[:3]
+        local_direction = (np.append(direction, 0) @ inv_mat)[:3]
+        return ray_triangle_test(self.get_triangles(maker), local_origin, local_direction)
+
+    def pick(self, from_pos, to_pos):
+        """Returns the PickResult of the nearest building on the segment
+           from from_pos to to_pos, or None.
+        """
+        origin = np.array(from_pos, dtype=np.float64)
+        direction = np.array(to_pos, dtype=np.float64) - origin
+        items, t_near = self.bvh.intersect_ray(origin, direction)
+        best = None
+
+        for item, t in zip(items.tolist(), t_near.tolist()):
+            if t > 1 or (best is not None and t >= best[0]):
+                break
+
+            if self.exact and self.items[item][1] is not None:
+                if (t := self.refine(item, origin, direction)) is None or t > 1:
+                    continue
+
+            if best is None or t < best[0]:
+                best = (t, item)
+
+        if best is None:
+            return None
+
+        t, item = best
+        index, piece = self.items[item]
+        return PickResult(self.buildings[index], piece, Point3(*(origin + direction * t)))
+
+    def select_box(self, lower, upper):
+        """Returns the buildings overlapping the box between lower and upper in world space."""
+        items = self.bvh.intersect_box(np.array(lower), np.array(upper))
+        return [self.buildings[i] for i in sorted({self.items[item][0] for item in items})]
+
+    def select_rect(self, camera, lens, corner_1, corner_2):
+        """Returns the buildings whose pieces have their centers
+           in the rectangle between two points on the film of the lens.
+        """
+        if not len(self.items):
+            return []
+
+        centers = (self.bvh.lower + self.bvh.upper) / 2
+        points = np.hstack([centers, np.ones((len(centers), 1))])
+        clip = points @ np.array(base.render.get_mat(camera)) @ np.array(lens.get_projection_mat())
+        film = clip[:, :2] / clip[:, 3:]
+
+        lower = np.minimum(corner_1, corner_2)
+        upper = np.maximum(corner_1, corner_2)
+        inside = (clip[:, 3] > 0) & np.all((film >= lower) & (film <= upper), axis=-1)
+        return [self.buildings[i] for i in sorted({self.items[item][0] for item in np.flatnonzero(inside)})]
@@ -0,0 +1,244 @@
+import numpy as np
+from panda3d.core import Point3, Vec3, LColor
+from panda3d.core import Texture
+
+from city import City, Building, Color
+from city import Cylinder, EllipticalPrism, RoundedBox
+
+
+class VoronoiCityGenerator(City, register=False):
+    """Generates a city from a Voronoi diagram instead of the hand-authored areas.
+       Seeds are scattered one per cell of a jittered grid, so that the neighbors of
+       each seed are found among the surrounding 5x5 grid cells with array operations.
+       The largest footprint that fits in each Voronoi cell without touching the
+       rounded-edge roads is filled with a stack chosen from the City.stack_* helpers;
+       cells too small for a building become parks.
+
+        Args:
+            cells_x (int): the number of Voronoi cells along the x axis.
+            cells_y (int): the number of Voronoi cells along the y axis.
+            cell_size (float): the average distance between seeds.
+            road_width (float): the width of the roads on the Voronoi edges.
+            seed (int): the seed of the random generator.
+            trees_per_park (int): the number of trees planted in each park.
+    """
+
+    recipes = ['build_boxes', 'build_cylinders', 'build_rotating_boxes', 'build_ellipses']
+    # the number of cells on each side of the blocks that group models for culling.
+    group_cells = 4
+
+    def __init__(self, cells_x=8, cells_y=8, cell_size=40, road_width=8, seed=None, trees_per_park=3):
+        super().__init__(seed=seed)
+        self.params = dict(cells_x=cells_x, cells_y=cells_y, cell_size=cell_size,
+                           road_width=road_width, seed=seed, trees_per_park=trees_per_park)
+        self.cells_x = cells_x
+        self.cells_y = cells_y
+        self.cell_size = cell_size
+        self.road_width = road_width
+        self.trees_per_park = trees_per_park
+
+        self.width = cells_x * cell_size
+        self.depth = cells_y * cell_size
+        self.seeds = self.scatter_seeds()
+        self.layout = self.plan()
+
+    def scatter_seeds(self):
+        iy, ix = np.mgrid[:self.cells_y, :self.cells_x]
+        jitter = self.rng.uniform(0.15, 0.85, (self.cells_y, self.cells_x, 2))
+        seeds = (np.stack([ix, iy], axis=-1) + jitter) * self.cell_size
+        return seeds - [self.width / 2, self.depth / 2]
+
+    def padded_seeds(self):
+        padded = np.full((self.cells_y + 4, self.cells_x + 4, 2), np.inf)
+        padded[2:-2, 2:-2] = self.seeds
+        return padded
+
+    def free_radius(self):
+        """Returns the radius of the largest circle around each seed that is
+           inside its Voronoi cell and does not overlap the roads.
+        """
+        padded = self.padded_seeds()
+        ny, nx = self.cells_y, self.cells_x
+        nearest = np.full((ny, nx), np.inf)
+
+        for dy in range(-2, 3):
+            for dx in range(-2, 3):
+                if dx or dy:
+                    other = padded[2 + dy:2 + dy + ny, 2 + dx:2 + dx + nx]
+                    nearest = np.minimum(nearest, np.linalg.norm(other - self.seeds, axis=-1))
+
+        # the edge of the map is treated as a road too.
+        x, y = self.seeds[..., 0], self.seeds[..., 1]
+        border = np.minimum.reduce([
+            x + self.width / 2, self.width / 2 - x, y + self.depth / 2, self.depth / 2 - y])
+
+        return np.minimum((nearest - self.road_width) / 2, border - self.road_width / 2)
+
+    def plan(self):
+        radius = self.free_radius().ravel()
+        seeds = self.seeds.reshape(-1, 2)
+        n = len(seeds)
+
+        # footprint of width x depth inscribed in the free circle.
+        ratio = self.rng.choice([0.5, 0.75, 1.0], n)
+        width = np.floor(2 * radius / np.sqrt(1 + ratio ** 2))
+        depth = np.floor(width * ratio)
+        is_park = (radius < 5) | (depth < 6)
+
+        # taller buildings toward the center of the city.
+        dist = np.linalg.norm(seeds, axis=-1) / (np.hypot(self.width, self.depth) / 2)
+        floors = np.clip(self.rng.poisson(3 + 12 * (1 - dist) ** 2), 1, 30)
+
+        # trees scattered in the free circle of the parks.
+        angles = self.rng.uniform(0, 2 * np.pi, (n, self.trees_per_park))
+        dist = self.rng.uniform(0, 1, (n, self.trees_per_park)) * np.floor(radius)[:, None]
+        trees = np.stack([
+            seeds[:, 0, None] + np.cos(angles) * dist,
+            seeds[:, 1, None] + np.sin(angles) * dist
+        ], axis=-1)
+
+        return dict(
+            x=seeds[:, 0],
+            y=seeds[:, 1],
+            h=self.rng.uniform(0, 90, n).round(),
+            radius=np.floor(radius),
+            width=width,
+            depth=depth,
+            floors=floors,
+            recipe=self.rng.integers(0, len(self.recipes), n),
+            is_park=is_park,
+            trees=trees,
+            # drawn last, so that the seeds keep planning the same streets and buildings.
+            color=self.rng.integers(0, len(Color.palette()), n),
+        )
+
+    def build(self, cells=None):
+        """cells: indices of the cells to build; all cells if None."""
+        layout = self.layout
+        cells = np.arange(len(layout['x'])) if cells is None else np.asarray(cells)
+        # the colors are planned by cell, so tiles get the same ones in any order.
+        colors = Color.palette()[layout['color']]
+
+        for i in cells[~layout['is_park'][cells]]:
+            recipe = getattr(self, self.recipes[layout['recipe'][i]])
+            recipe(
+                f'cell_{i}', layout['x'][i], layout['y'][i], layout['h'][i], layout['radius'][i],
+                layout['width'][i], layout['depth'][i], int(layout['floors'][i]), LColor(*colors[i])
+            )
+
+        parks = cells[layout['is_park'][cells] & (layout['radius'][cells] >= 1)]
+        if len(parks):
+            self.plant_trees(*layout['trees'][parks].reshape(-1, 2).tolist())
+
+    def get_group_name(self, model):
+        size = self.cell_size * self.group_cells
+        gx = int((model.get_x() + self.width / 2) // size)
+        gy = int((model.get_y() + self.depth / 2) // size)
+        return f'block_{gx}_{gy}'
+
+    def build_detached(self, cells, root):
+        """Builds the cells under root without touching the scene or the Bullet world,
+           so that it can run outside the main thread. Returns the builder used.
+        """
+        builder = self.detached(root)
+        builder.build(cells)
+        return builder
+
+    def build_boxes(self, name, x, y, h, radius, width, depth, floors, color=None):
+        building = Building(name, Point3(x, y, 2.5), Vec3(h, 0, 0), color)
+        args = dict(corner_radius=min(depth / 4, 5))
+        maker_1 = RoundedBox(width=width, depth=depth, height=5, **args)
+        maker_2 = RoundedBox(width=width - 2, depth=depth - 2, height=0.5, **args)
+        self.stack_alternating_boxes(building, floors * 2 - 1, maker_1, maker_2)
+
+    def build_cylinders(self, name, x, y, h, radius, width, depth, floors, color=None):
+        building = Building(name, Point3(x, y, 0), Vec3(h, 0, 0), color)
+        maker_1 = Cylinder(radius=radius, height=5)
+        maker_2 = Cylinder(radius=radius - 2, height=0.5)
+        self.stack_alternating_prisms(building, floors * 2 - 1, maker_1, maker_2)
+
+    def build_rotating_boxes(self, name, x, y, h, radius, width, depth, floors, color=None):
+        building = Building(name, Point3(x, y, 2.5), Vec3(h, 0, 0), color)
+        # a square rotated around its center stays in the circle.
+        size = np.floor(radius * np.sqrt(2))
+        maker = RoundedBox(width=size, depth=size, height=5, corner_radius=min(size / 4, 4))
+        self.stack_rotating_boxes(building, maker, max(floors // 2, 1), [0, 45])
+
+    def build_ellipses(self, name, x, y, h, radius, width, depth, floors, color=None):
+        building = Building(name, Point3(x, y, 0), Vec3(h, 0, 0), color)
+        minor = max(np.floor(radius * depth / width), 3)
+        maker_1 = EllipticalPrism(major_axis=radius, minor_axis=minor, height=5)
+        maker_2 = EllipticalPrism(major_axis=radius - 2, minor_axis=minor - 2, height=0.5)
+        self.stack_alternating_prisms(building, floors * 2 - 1, maker_1, maker_2)
+
+    def road_texture(self, size=1024, block=256, road=0.82, ground=0.75, smoothness=2.0):
+        """Renders the Voronoi edges with rounded corners as roads,
+           like images/voronoi_region.png, into a grayscale texture.
+        """
+        img = self.road_image(-self.width / 2, -self.depth / 2, self.width / 2, self.depth / 2,
+                              size, size, block, road, ground, smoothness)
+
+        tex = Texture('voronoi_roads')
+        tex.setup_2d_texture(size, size, Texture.T_unsigned_byte, Texture.F_luminance)
+        # the first row of the ram image is the bottom of the texture.
+        tex.set_ram_image(img.tobytes())
+        return tex
+
+    def road_image(self, x0, y0, x1, y1, width, height, block=256, road=0.82, ground=0.75, smoothness=2.0):
+        """Renders the roads in the region from (x0, y0) to (x1, y1) into a grayscale array
+           of height rows and width columns, whose first row is at y0. The edges of the roads
+           are blended over one texel, so they stay sharp at any resolution.
+        """
+        img = np.empty((height, width), dtype=np.uint8)
+        px = (x0 + (np.arange(width) + 0.5) / width * (x1 - x0)).astype(np.float32)
+        texel = (x1 - x0) / width
+
+        for start in range(0, height, block):
+            py = y0 + (np.arange(start, min(start + block, height)) + 0.5) / height * (y1 - y0)
+            x, y = np.meshgrid(px, py.astype(np.float32))
+            soft = self.soft_edge_distance(x, y, smoothness)
+            t = np.clip((soft - self.road_width / 2) / texel + 0.5, 0, 1)
+            img[start:start + len(py)] = ((road + (ground - road) * t) * 255).astype(np.uint8)
+
+        return img
+
+    def soft_edge_distance(self, x, y, smoothness):
+        """Returns the distance from the points to the nearest Voronoi edge or the map edge,
+           blended by a smooth minimum, which rounds the corners where edges meet.
+        """
+        padded = self.padded_seeds().astype(np.float32)
+        seeds_x, seeds_y = padded[..., 0].ravel(), padded[..., 1].ravel()
+        stride = self.cells_x + 4
+
+        cx = np.clip(((x + self.width / 2) // self.cell_size).astype(np.int32), 0, self.cells_x - 1) + 2
+        cy = np.clip(((y + self.depth / 2) // self.cell_size).astype(np.int32), 0, self.cells_y - 1) + 2
+        cell = cy * stride + cx
+        offsets = [dy * stride + dx for dy in range(-2, 3) for dx in range(-2, 3)]
+
+        # the nearest seed among the 5x5 grid cells around each point.
+        d1 = np.full(x.shape, np.inf, dtype=np.float32)
+        nearest = np.zeros(x.shape, dtype=np.int32)
+
+        for offset in offsets:
+            idx = cell + offset
+            d2 = (seeds_x.take(idx) - x) ** 2 + (seeds_y.take(idx) - y) ** 2
+            closer = d2 < d1
+            nearest[closer] = idx[closer]
+            np.minimum(d1, d2, out=d1)
+
+        s1_x, s1_y = seeds_x.take(nearest), seeds_y.take(nearest)
+
+        # distances to the bisectors between the nearest seed and the others.
+        total = np.zeros(x.shape, dtype=np.float32)
+
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            for offset in offsets:
+                sx, sy = seeds_x.take(cell + offset), seeds_y.take(cell + offset)
+                d2 = (sx - x) ** 2 + (sy - y) ** 2
+                edge = (d2 - d1) / (2 * np.hypot(sx - s1_x, sy - s1_y))
+                total += np.where(edge > 0, np.exp(-edge / smoothness), 0)
+
+            for edge in (x + self.width / 2, self.width / 2 - x, y + self.depth / 2, self.depth / 2 - y):
+                total += np.exp(-edge / smoothness)
+
+        return -smoothness * np.log(total + 1e-12)
@@ -0,0 +1,194 @@
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+import numpy as np
+from direct.gui.OnscreenText import OnscreenText
+from panda3d.core import TextNode
+
+
+class Profiler:
+    """Records time spans by category: 'area', 'stack', 'maker' and 'shape' while building,
+       and 'frame' for the spans of each frame, of which only the latest are kept.
+       The build events are totaled as they are added; only the latest are kept for the trace.
+       Rendering and the detailed spans, made for every piece or frame, are recorded
+       only while enabled, e.g. while the overlay is shown.
+    """
+
+    def __init__(self, max_build_events=100000, max_frame_events=3000):
+        self.origin = time.perf_counter()
+        self.build_events = deque(maxlen=max_build_events)
+        self.frame_events = deque(maxlen=max_frame_events)
+        # {category: {name: [count, seconds]}} of all the build events
+        self.totals = {}
+        self.lock = threading.Lock()
+        self.render_start = None
+        self.enabled = False
+        # {name: text} of the values reported besides the timings, e.g. memory savings
+        self.stats = {}
+
+    def add(self, name, category, start, duration):
+        event = (name, category, start - self.origin, duration, threading.get_ident())
+
+        if category == 'frame':
+            self.frame_events.append(event)
+            return
+
+        self.build_events.append(event)
+
+        # spans are added from the threaded task chains too.
+        with self.lock:
+            total = self.totals.setdefault(category, {}).setdefault(name, [0, 0])
+            total[0] += 1
+            total[1] += duration
+
+    @contextmanager
+    def span(self, name, category, detailed=False):
+        if detailed and not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, time.perf_counter() - start)
+
+    def timed(self, category, detailed=False):
+        """Decorator recording the calls of the function under its name."""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if detailed and not self.enabled:
+                    return func(*args, **kwargs)
+
+                with self.span(func.__name__, category):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def set_stat(self, name, text):
+        self.stats[name] = text
+
+    def enable(self):
+        self.enabled = True
+        self.start_render_timing()
+
+    def disable(self):
+        self.enabled = False
+        self.stop_render_timing()
+
+    def start_render_timing(self):
+        """Times rendering by tasks sorted just before and after igLoop,
+           which culls and draws the frame in one call.
+        """
+        self.stop_render_timing()
+        base.taskMgr.add(self.begin_render, 'profile_render_begin', sort=49)
+        base.taskMgr.add(self.end_render, 'profile_render_end', sort=51)
+
+    def stop_render_timing(self):
+        base.taskMgr.remove('profile_render_begin')
+        base.taskMgr.remove('profile_render_end')
+        self.render_start = None
+
+    def begin_render(self, task):
+        self.render_start = time.perf_counter()
+        return task.cont
+
+    def end_render(self, task):
+        if self.render_start is not None:
+            self.add('cull+draw', 'frame', self.render_start, time.perf_counter() - self.render_start)
+        return task.cont
+
+    def build_totals(self):
+        """Returns {category: {name: (count, seconds)}} of all the build events, largest first."""
+        with self.lock:
+            totals = {category: [(name, tuple(total)) for name, total in names.items()]
+                      for category, names in self.totals.items()}
+
+        return {category: dict(sorted(names, key=lambda item: -item[1][1]))
+                for category, names in totals.items()}
+
+    def frame_stats(self):
+        """Returns {name: (mean, 95th percentile, max)} in milliseconds of the frame events."""
+        durations = {}
+        for name, _, _, duration, _ in self.frame_events:
+            durations.setdefault(name, []).append(duration * 1000)
+
+        return {name: (np.mean(values), np.percentile(values, 95), np.max(values))
+                for name, values in durations.items()}
+
+    def export_json(self, path):
+        data = dict(
+            build={category: {name: dict(count=count, seconds=seconds)
+                              for name, (count, seconds) in names.items()}
+                   for category, names in self.build_totals().items()},
+            frames={name: dict(mean_ms=mean, p95_ms=p95, max_ms=peak)
+                    for name, (mean, p95, peak) in self.frame_stats().items()},
+            stats=self.stats
+        )
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
+
+    def export_trace(self, path):
+        """Writes all the events in the Chrome trace event format (chrome://tracing, Perfetto)."""
+        events = [
+            dict(name=name, cat=category, ph='X', ts=start * 1e6, dur=duration * 1e6, pid=0, tid=tid)
+            for name, category, start, duration, tid in (*self.build_events, *self.frame_events)
+        ]
+        with open(path, 'w') as f:
+            json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f)
+
+
+class ProfilerOverlay:
+    """Shows the frame timings and the slowest parts of the build on the screen."""
+
+    def __init__(self, profiler, interval=0.5, rows=5):
+        self.profiler = profiler
+        self.interval = interval
+        self.rows = rows
+        self.text = OnscreenText(
+            parent=base.a2dTopLeft,
+            pos=(0.05, -0.1),
+            scale=0.04,
+            fg=(1, 1, 1, 1),
+            bg=(0, 0, 0, 0.5),
+            align=TextNode.ALeft,
+            mayChange=True
+        )
+        self.text.hide()
+
+    def toggle(self):
+        if self.text.is_hidden():
+            self.text.show()
+            self.profiler.enable()
+            base.taskMgr.do_method_later(0, self.update, 'update_profiler_overlay')
+        else:
+            self.text.hide()
+            self.profiler.disable()
+            base.taskMgr.remove('update_profiler_overlay')
+
+    def update(self, task):
+        lines = ['frame (ms)     mean    p95    max']
+        for name, (mean, p95, peak) in self.profiler.frame_stats().items():
+            lines.append(f'{name:<12} {mean:6.2f} {p95:6.2f} {peak:6.2f}')
+
+        if self.profiler.stats:
+            lines.append('')
+        for name, text in self.profiler.stats.items():
+            lines.append(f'{name:<20} {text}')
+
+        for category, names in self.profiler.build_totals().items():
+            lines.append(f'\n{category} (s)')
+            for name, (count, seconds) in list(names.items())[:self.rows]:
+                lines.append(f'{name:<28} {count:5d} {seconds:7.3f}')
+
+        self.text.text = '\n'.join(lines)
+        task.delay_time = self.interval
+        return task.again
+
+
+profiler = Profiler()
@@ -1,23 +1,35 @@
+import building_materials
 from panda3d.bullet import BulletRigidBodyNode
 from panda3d.bullet import BulletTriangleMeshShape
 from panda3d.bullet import BulletTriangleMesh
-from panda3d.core import NodePath, PandaNode
-from panda3d.core import BitMask32, Point3
-from panda3d.core import TexGenAttrib, TextureStage
+from panda3d.core import NodePath, PandaNode, CardMaker, CullBinManager
+from panda3d.core import BitMask32, Point3, OmniBoundingVolume
+from panda3d.core import TexGenAttrib, TextureStage, Shader, DepthTestAttrib, RenderAttrib
 
-from city import City
+from caches import geom_cache, maker_from_key
+from city import City, Building
+from city_cache import BakedCity, load_cube_map
+from forest import Forest
+from geom_utils import compact_geom_nodes
+from ground import ChunkedGround, ImageRoads
+from layouts import load_layout, layout_digest
+from streaming import CityStreamer
 from lights import BasicAmbientLight, BasicDayLight
+from profiling import profiler
 from shapes.src import Sphere, Plane
 
 
 class Ground(NodePath):
 
-    def __init__(self, w=256, d=256, segs_w=16, segs_d=16):
+    def __init__(self, w=256, d=256, segs_w=16, segs_d=16, texture=None):
         super().__init__(BulletRigidBodyNode('ground'))
 
         plane = Plane(w, d, segs_w, segs_d)
         self.model = plane.create()
-        self.model.set_texture(base.loader.load_texture('images/voronoi_region.png'))
+
+        if texture is None:
+            texture = base.loader.load_texture('images/voronoi_region.png')
+        self.model.set_texture(texture)
         self.model.set_pos(0, 0, 0)
         self.model.reparent_to(self)
         self.set_tag('category', 'ground')
@@ -32,10 +44,20 @@ class Ground(NodePath):
 
 
 class SkyBox(NodePath):
+    """mode: 'sphere' draws the cube map on a sphere with world cube map texgen;
+             'fullscreen' draws it by one card covering the screen at the far plane,
+             after the opaque geometry, so that only the pixels left empty are shaded.
+             The cube map is then loaded from a compressed, mipmapped cache file.
+    """
 
-    def __init__(self):
+    def __init__(self, mode='sphere'):
         super().__init__(PandaNode('skybox'))
-        self.make_skybox()
+        self.mode = mode
+
+        if mode == 'fullscreen':
+            self.make_fullscreen_sky()
+        else:
+            self.make_skybox()
 
     def make_skybox(self):
         self.sphere = Sphere(radius=500).create()
@@ -52,29 +74,245 @@ class SkyBox(NodePath):
         imgs = base.loader.load_cube_map('images/skybox/img_#.png')
         self.sphere.set_texture(imgs)
 
+    def make_fullscreen_sky(self):
+        # drawn after the opaque bin and before the transparent one.
+        manager = CullBinManager.get_global_ptr()
+        if manager.find_bin('sky') < 0:
+            manager.add_bin('sky', CullBinManager.BT_unsorted, 25)
+
+        cm = CardMaker('sky')
+        cm.set_frame(-1, 1, -1, 1)
+        self.card = self.attach_new_node(cm.generate())
+        # the vertex shader places the card on the screen, so it must not be culled.
+        self.card.node().set_bounds(OmniBoundingVolume())
+        self.card.node().set_final(True)
+
+        self.card.set_shader(Shader.load(Shader.SL_GLSL, 'shaders/skybox.vert', 'shaders/skybox.frag'))
+        self.card.set_texture(load_cube_map('images/skybox/img_#.png'))
+        self.card.set_attrib(DepthTestAttrib.make(RenderAttrib.M_less_equal))
+        self.card.set_depth_write(False)
+        self.card.set_bin('sky', 0)
+        self.card.set_light_off()
+        self.card.set_material_off()
+
 
 class Scene(NodePath):
+    """generator: VoronoiCityGenerator; if given, the city and the ground
+                  are generated by it instead of the hand-authored areas.
+       shadow_quality: the tier of the shadow map size in BasicDayLight.shadow_sizes.
+       chunked_ground: parameters of ChunkedGround; if given, the ground is split into chunks
+                       whose road textures are sharper near the camera, instead of one Ground.
+       sky_mode: 'sphere' or 'fullscreen'; see SkyBox.
+    """
 
-    def __init__(self):
+    def __init__(self, generator=None, shadow_quality='ultra', chunked_ground=None, sky_mode='sphere'):
         super().__init__(PandaNode('scene'))
         self.reparent_to(base.render)
+        self.generator = generator
 
         self.ambient_light = BasicAmbientLight()
-        self.day_light = BasicDayLight()
+        self.day_light = BasicDayLight(shadow_quality)
+
+        if chunked_ground is not None:
+            if generator is None:
+                self.ground = ChunkedGround(
+                    ImageRoads('images/voronoi_region.png', 256, 256), 256, 256, **chunked_ground)
+            else:
+                self.ground = ChunkedGround(generator, generator.width, generator.depth, **chunked_ground)
+            self.ground.start()
+        elif generator is None:
+            self.ground = Ground()
+        else:
+            w, d = generator.width, generator.depth
+            self.ground = Ground(w, d, max(16, int(w / 16)), max(16, int(d / 16)), generator.road_texture())
 
-        self.ground = Ground()
         self.ground.reparent_to(self)
         self.ground.set_pos(Point3(0, 0, 0))
         base.world.attach(self.ground.node())
 
         self.city_root = NodePath('city')
         self.city_root.reparent_to(self)
+        self.forest = None
+        self.streamer = None
+        self.area_builders = []
+        # the bytes of the vertex data of the buildings before and after compaction
+        self.compacted = [0, 0]
 
-        self.sky = SkyBox()
+        self.sky = SkyBox(sky_mode)
         self.sky.reparent_to(self)
         self.sky.set_pos(0, 0, -100)
 
-    def create_city(self):
-        for area in City.areas:
-            area_builder = area()
-            area_builder.build()
+    def create_city(self, flatten=None, instanced_trees=False, streaming=False, workers=0,
+                    bake=False, seed=None, lod=None, tessellation=None, light_baker=None,
+                    occluders=0, vectorized=False, compact=False, layout=None, palette=False,
+                    collision_hull=None):
+        """flatten: 'building' or 'area' merges the geometry of every area,
+                    overriding City.flatten_mode of each area.
+           instanced_trees: if True, the trees of all areas are drawn by one Forest.
+           streaming: if True, the tiles of the generated city are loaded around
+                      the camera by CityStreamer instead of being built here.
+           workers: if more than 1, the geometry of the buildings is generated
+                    in this number of worker processes before building.
+           bake: if True, the city is loaded from the bake made by an earlier launch
+                 with the same sources and arguments, or baked after building.
+           seed: the seed of the colors of the areas and of the forest; a generated city
+                 is seeded by its own parameters.
+           lod: (near, far); if given, buildings switch to reduced geometry beyond near
+                and to a bounding box beyond far.
+           tessellation: TessellationPolicy replacing the default segment counts of all materials.
+           light_baker: LightBaker; if given, the lighting of the buildings is baked
+                        into their vertex colors; not applied to streamed tiles.
+           occluders: the number of the largest buildings whose solid cores hide
+                      what is behind them from the culling; not applied to streamed tiles.
+           vectorized: if True, the materials that support it are generated with NumPy.
+           compact: if True, the vertices of the buildings are stored as 16 bit integers
+                    after flattening and baking, without texcoords.
+           layout: the path of a layout file made by layouts.py; if given,
+                   the city is built from it instead of the areas or the generator.
+           palette: if True, flattened buildings are colored by one palette texture
+                    through their texcoords instead of a color state per building.
+           collision_hull: dict(mode, tolerance, max_points) replacing Building.hull_mode,
+                           hull_tolerance and hull_max_points, which simplify the convex
+                           hulls the buildings collide through; see Building.
+        """
+        if tessellation is not None:
+            building_materials.default_policy = tessellation
+
+        if collision_hull is not None:
+            Building.hull_mode = collision_hull.get('mode', Building.hull_mode)
+            Building.hull_tolerance = collision_hull.get('tolerance', Building.hull_tolerance)
+            Building.hull_max_points = collision_hull.get('max_points', Building.hull_max_points)
+
+        building_materials.default_vectorized = vectorized
+
+        if streaming and self.generator is not None and layout is None:
+            self.streamer = CityStreamer(self.generator, flatten=flatten, compact=compact, palette=palette)
+            self.streamer.start()
+            return
+
+        if bake:
+            baked = BakedCity(dict(
+                flatten=flatten,
+                instanced_trees=instanced_trees,
+                seed=seed,
+                lod=lod,
+                tessellation=repr(building_materials.default_policy),
+                light_baker=repr(light_baker),
+                occluders=occluders,
+                vectorized=vectorized,
+                compact=compact,
+                palette=palette,
+                layout=None if layout is None else layout_digest(layout),
+                generator=None if self.generator is None else self.generator.params,
+                hull=(Building.hull_mode, Building.hull_tolerance, Building.hull_max_points)
+            ))
+            if baked.load(self.city_root):
+                # bam files do not store shader attribs.
+                for forest in self.city_root.find_all_matches('**/=instances'):
+                    Forest.restore(forest)
+                if light_baker is not None:
+                    light_baker.restore(self.city_root)
+
+                self.enable_occluders()
+                return
+
+        if instanced_trees:
+            self.forest = Forest(seed=seed)
+
+        if layout is not None:
+            with profiler.span('load layout', 'startup'):
+                area_builders = load_layout(layout)
+        elif self.generator is not None:
+            area_builders = [self.generator]
+        else:
+            area_builders = City.create_areas(seed)
+
+        self.area_builders = area_builders
+
+        if workers > 1:
+            self.prefetch_geometry(area_builders, workers, lod is not None)
+
+        for area_builder in area_builders:
+            with profiler.span(area_builder.__class__.__name__, 'area'):
+                area_builder.build()
+                area_builder.assign_colors()
+
+                if lod is not None:
+                    area_builder.make_lods(*lod)
+
+                area_builder.flatten(flatten, palette)
+
+        if occluders:
+            with profiler.span('occluders', 'startup'):
+                self.add_occluders(occluders)
+
+        if light_baker is not None:
+            with profiler.span('bake lighting', 'startup'):
+                light_baker.bake(self.city_root, self.get_buildings(), self.ambient_light, self.day_light)
+
+        if compact:
+            with profiler.span('compact vertices', 'startup'):
+                self.compact_buildings(self.city_root)
+
+        if self.forest is not None:
+            self.forest.grow()
+            self.forest.reparent_to(self.city_root)
+            base.world.attach(self.forest.node())
+
+        if bake:
+            # an OccluderEffect cannot be read back from a bam file.
+            self.city_root.clear_occluder()
+            baked.save(self.city_root)
+            self.enable_occluders()
+
+    def get_buildings(self):
+        if self.streamer is not None:
+            return self.streamer.get_buildings()
+
+        if self.area_builders:
+            return [b for area_builder in self.area_builders for b in area_builder.buildings]
+
+        # the city loaded from a bake has no Building objects.
+        return self.city_root.find_all_matches('**/=category=object')
+
+    def compact_buildings(self, root):
+        # trees are textured.
+        geom_nps = [geom_np for geom_np in root.find_all_matches('**/+GeomNode')
+                    if geom_np.get_net_tag('category') != 'tree']
+        before, after = compact_geom_nodes(geom_nps)
+        self.compacted[0] += before
+        self.compacted[1] += after
+        profiler.set_stat(
+            'compacted vertices', f'{self.compacted[0] / 2 ** 20:.2f} -> {self.compacted[1] / 2 ** 20:.2f} MB')
+
+    def add_occluders(self, max_occluders, min_height=20, min_radius=4):
+        cores = []
+
+        for building in self.get_buildings():
+            if (core := building.get_occluder_core(min_height, min_radius)) is not None:
+                _, _, radius, bottom, top = core
+                cores.append((radius * (top - bottom), building, core))
+
+        cores.sort(key=lambda item: -item[0])
+
+        for _, building, core in cores[:max_occluders]:
+            building.add_occluders(*core)
+
+        self.enable_occluders()
+
+    def enable_occluders(self):
+        for occluder in self.city_root.find_all_matches('**/+OccluderNode'):
+            self.city_root.set_occluder(occluder)
+
+    def prefetch_geometry(self, area_builders, workers, reduced=False):
+        """Runs the builds without generating anything to collect the makers used,
+           and generates their geometry in worker processes.
+        """
+        with geom_cache.plan() as keys:
+            for area_builder in area_builders:
+                area_builder.detached(NodePath('plan'), planning=True).build()
+
+        if reduced:
+            keys |= {maker_from_key(key).reduced().key for key in keys}
+
+        geom_cache.generate(keys, workers)
@@ -0,0 +1,29 @@
+#version 150
+
+uniform sampler2D p3d_Texture0;
+uniform struct p3d_LightModelParameters {
+    vec4 ambient;
+} p3d_LightModel;
+uniform struct p3d_LightSourceParameters {
+    vec4 color;
+    vec4 position;
+} p3d_LightSource[1];
+
+in vec2 uv;
+in vec4 color;
+in vec3 normal;
+
+out vec4 frag_color;
+
+void main() {
+    vec4 base_color = texture(p3d_Texture0, uv) * color;
+    if (base_color.a < 0.5) {
+        discard;
+    }
+
+    // p3d_LightSource[0] is the directional light; its position is the direction in view space.
+    vec3 light_dir = normalize(p3d_LightSource[0].position.xyz);
+    float diffuse = max(dot(normalize(normal), light_dir), 0);
+    vec3 light = p3d_LightModel.ambient.rgb + p3d_LightSource[0].color.rgb * diffuse;
+    frag_color = vec4(base_color.rgb * light, base_color.a);
+}
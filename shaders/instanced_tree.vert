@@ -0,0 +1,32 @@
+#version 150
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform mat3 p3d_NormalMatrix;
+uniform samplerBuffer instances;
+
+in vec4 p3d_Vertex;
+in vec3 p3d_Normal;
+in vec4 p3d_Color;
+in vec2 p3d_MultiTexCoord0;
+
+out vec2 uv;
+out vec4 color;
+out vec3 normal;
+
+void main() {
+    // two texels per tree: (x, y, z, scale) and (cos(h), sin(h), 0, 0)
+    vec4 pos_scale = texelFetch(instances, gl_InstanceID * 2);
+    vec4 rotation = texelFetch(instances, gl_InstanceID * 2 + 1);
+    mat3 rot = mat3(
+        rotation.x, rotation.y, 0,
+        -rotation.y, rotation.x, 0,
+        0, 0, 1
+    );
+
+    vec3 vert = rot * p3d_Vertex.xyz * pos_scale.w + pos_scale.xyz;
+    gl_Position = p3d_ModelViewProjectionMatrix * vec4(vert, 1);
+
+    normal = normalize(p3d_NormalMatrix * (rot * p3d_Normal));
+    uv = p3d_MultiTexCoord0;
+    color = p3d_Color;
+}
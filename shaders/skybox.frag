@@ -0,0 +1,12 @@
+#version 150
+
+uniform samplerCube p3d_Texture0;
+
+in vec3 direction;
+
+out vec4 frag_color;
+
+void main() {
+    // the same lookup as the world cube map texgen of the sphere, seen from its center.
+    frag_color = texture(p3d_Texture0, vec3(-direction.xy, direction.z));
+}
@@ -0,0 +1,18 @@
+#version 150
+
+uniform mat4 p3d_ProjectionMatrixInverse;
+uniform mat4 p3d_ViewMatrixInverse;
+
+in vec4 p3d_Vertex;
+
+out vec3 direction;
+
+void main() {
+    // the card covers the screen at the far plane, whatever its transform;
+    // it is drawn with a less-equal depth test where nothing else was drawn.
+    vec4 pos = vec4(p3d_Vertex.xz, 1, 1);
+    gl_Position = pos;
+
+    vec4 view = p3d_ProjectionMatrixInverse * pos;
+    direction = mat3(p3d_ViewMatrixInverse) * (view.xyz / view.w);
+}
@@ -0,0 +1,191 @@
+from collections import deque
+
+import numpy as np
+from panda3d.core import NodePath, Thread
+from panda3d.core import SceneGraphAnalyzer
+
+from profiling import profiler
+
+
+class CityStreamer:
+    """Splits a VoronoiCityGenerator city into square tiles and keeps only the tiles
+       around the camera in the scene. Tiles are built on a threaded task chain
+       under detached nodes, then parented to city_root and their Bullet nodes
+       attached to the world on the main thread; tiles out of range are detached
+       and released. If the loaded tiles exceed the memory budget, the farthest
+       ones are released first, and are not loaded again until the memory drops
+       below the budget by the margin or they become nearer than a loaded tile.
+       Tiles being loaded count against the budget by the size they are expected to have.
+
+        Args:
+            generator (VoronoiCityGenerator): the city to stream.
+            tile_size (float): the length of the sides of a tile.
+            load_radius (float): tiles whose centers are within this distance
+                                 from the camera on the ground are loaded.
+            unload_radius (float): tiles farther than this are released.
+            memory_budget (float): the upper limit of the vertex data of the
+                                   loaded tiles in megabytes.
+            budget_margin (float): the fraction of the budget that must be free
+                                   before the tiles released for it are loaded again.
+            max_attach (int): the number of tiles attached per frame at most.
+            flatten (str): the flatten mode of the tiles; see City.flatten_mode.
+            compact (bool): if True, the vertices of the tiles are stored as 16 bit integers.
+            palette (bool): if True, the flattened buildings are colored by the palette texture.
+    """
+
+    def __init__(self, generator, tile_size=160, load_radius=400, unload_radius=560,
+                 memory_budget=256, budget_margin=0.1, max_attach=1, flatten=None, compact=False, palette=False):
+        self.generator = generator
+        self.tile_size = tile_size
+        self.load_radius = load_radius
+        self.unload_radius = unload_radius
+        self.memory_budget = memory_budget * 1024 * 1024
+        self.budget_margin = budget_margin
+        self.max_attach = max_attach
+        self.flatten = flatten
+        self.compact = compact
+        self.palette = palette
+
+        self.tiles, self.centers = self.split_tiles()
+        self.loaded = {}
+        self.loading = set()
+        self.finished = deque()
+        # the sizes of the tiles loaded so far, and the tiles released for the budget.
+        self.sizes = {}
+        self.evicted = set()
+        # incremented whenever tiles are attached or released.
+        self.version = 0
+
+        if Thread.is_threading_supported():
+            self.task_chain = 'city_tiles'
+            base.taskMgr.setupTaskChain(self.task_chain, numThreads=1, frameSync=False)
+        else:
+            self.task_chain = None
+
+    def split_tiles(self):
+        layout = self.generator.layout
+        tx = ((layout['x'] + self.generator.width / 2) // self.tile_size).astype(int)
+        ty = ((layout['y'] + self.generator.depth / 2) // self.tile_size).astype(int)
+
+        keys = list(zip(ty.tolist(), tx.tolist()))
+        tiles = {}
+        for i, key in enumerate(keys):
+            tiles.setdefault(key, []).append(i)
+
+        centers = {
+            key: ((key[1] + 0.5) * self.tile_size - self.generator.width / 2,
+                  (key[0] + 0.5) * self.tile_size - self.generator.depth / 2)
+            for key in tiles
+        }
+        return tiles, centers
+
+    def start(self):
+        base.taskMgr.add(self.update, 'stream_city')
+
+    def get_distances(self, pos):
+        keys = list(self.centers)
+        centers = np.array([self.centers[key] for key in keys])
+        dist = np.linalg.norm(centers - [pos.x, pos.y], axis=-1)
+        return dict(zip(keys, dist.tolist()))
+
+    def get_focus(self):
+        """Returns the point on the ground that the camera is above."""
+        return base.camera.get_pos(base.render)
+
+    def update(self, task):
+        dist = self.get_distances(self.get_focus())
+        memory = self.get_memory()
+
+        if memory < self.memory_budget * (1 - self.budget_margin):
+            self.evicted.clear()
+
+        expected = memory + sum(self.estimate_size(k) for k in self.loading)
+        # the loaded tiles that nearer tiles may replace, the farthest last.
+        replaceable = sorted(self.loaded, key=dist.get)
+
+        for key in sorted((k for k in self.tiles if dist[k] <= self.load_radius), key=dist.get):
+            if key in self.loaded or key in self.loading:
+                continue
+            # the size of the first tile is the estimate of the others.
+            if not self.sizes and self.loading:
+                break
+
+            size = self.estimate_size(key)
+
+            if expected + size > self.memory_budget or key in self.evicted:
+                if not replaceable or dist[replaceable[-1]] <= dist[key]:
+                    break
+                # the farthest tile is released for the budget after this one is attached.
+                expected -= self.loaded[replaceable.pop()][1]
+
+            expected += size
+            self.loading.add(key)
+            base.taskMgr.add(
+                self.load_tile, f'load_tile_{key}', extraArgs=[key], taskChain=self.task_chain)
+
+        for _ in range(min(self.max_attach, len(self.finished))):
+            key, root, size, buildings = self.finished.popleft()
+            self.loading.discard(key)
+            self.sizes[key] = size
+
+            if dist[key] <= self.unload_radius:
+                self.attach_tile(key, root, size, buildings)
+
+        for key in [k for k in self.loaded if dist[k] > self.unload_radius]:
+            self.release_tile(key)
+
+        # release the farthest tiles while over the budget.
+        for key in sorted(self.loaded, key=dist.get, reverse=True):
+            if self.get_memory() <= self.memory_budget:
+                break
+            self.release_tile(key)
+            self.evicted.add(key)
+
+        return task.cont
+
+    def estimate_size(self, key):
+        """Returns the size of the tile when it was last loaded,
+           or the mean size of the tiles loaded so far.
+        """
+        if (size := self.sizes.get(key)) is not None:
+            return size
+
+        return sum(self.sizes.values()) / len(self.sizes) if self.sizes else 0
+
+    def load_tile(self, key):
+        root = NodePath(f'tile_{key[0]}_{key[1]}')
+
+        with profiler.span(root.get_name(), 'area'):
+            builder = self.generator.build_detached(self.tiles[key], root)
+            builder.flatten(self.flatten, self.palette)
+
+            if self.compact:
+                base.scene.compact_buildings(root)
+
+        analyzer = SceneGraphAnalyzer()
+        analyzer.add_node(root.node())
+        self.finished.append((key, root, analyzer.get_vertex_data_size(), builder.buildings))
+
+    def attach_tile(self, key, root, size, buildings):
+        root.reparent_to(base.scene.city_root)
+
+        for body in root.find_all_matches('**/+BulletBodyNode'):
+            base.world.attach(body.node())
+
+        self.loaded[key] = (root, size, buildings)
+        self.version += 1
+
+    def release_tile(self, key):
+        root, _, _ = self.loaded.pop(key)
+
+        for body in root.find_all_matches('**/+BulletBodyNode'):
+            base.world.remove(body.node())
+
+        root.remove_node()
+        self.version += 1
+
+    def get_memory(self):
+        return sum(size for _, size, _ in self.loaded.values())
+
+    def get_buildings(self):
+        return [b for _, _, buildings in self.loaded.values() for b in buildings]
@@ -8,6 +8,12 @@ from panda3d.core import NodePath
 from panda3d.core import AntialiasAttrib
 from panda3d.core import load_prc_file_data
 
+from building_materials import TessellationPolicy
+from light_baking import LightBaker
+from lights import ShadowController
+from picking import Picker
+from profiling import profiler, ProfilerOverlay
+from procedural import VoronoiCityGenerator
 from scene import Scene
 
 
@@ -25,6 +31,102 @@ load_prc_file_data("", """
 # If set to True, the clicked building can be moved or rotated.
 UNDER_CONSTRUCTION = False
 
+# None, 'building' or 'area': merges the geometry of each building or area after build.
+FLATTEN = None
+
+# If set to True, all trees are drawn with one instanced draw call.
+INSTANCED_TREES = False
+
+# Parameters of VoronoiCityGenerator, e.g. dict(cells_x=100, cells_y=100, seed=1);
+# if None, the hand-authored areas in city.py are built.
+PROCEDURAL_CITY = None
+
+# If set to True, the tiles of the procedural city are loaded and released around the camera.
+STREAMING = False
+
+# Parameters of ChunkedGround, e.g. dict(chunk_size=64); if given, the ground is split into chunks
+# whose road textures are rendered sharper near the camera and coarser far away,
+# each chunk colliding by its own shape. One textured plane if None.
+CHUNKED_GROUND = None
+
+# The number of worker processes generating the geometry of the buildings;
+# 0 generates it in this process.
+WORKERS = 0
+
+# If set to True, the built city is saved under cache/ and loaded by later launches
+# as long as the sources and the settings above are unchanged.
+BAKE = False
+
+# How the sky is drawn: 'sphere' by a textured sphere around the city, or 'fullscreen' by one
+# pass over the pixels left empty after the opaque geometry, with the cube map loaded
+# from a compressed, mipmapped file under cache/ made by the first launch.
+SKY_MODE = 'sphere'
+
+# The seed of the building colors and the trees of the areas; random if None.
+SEED = None
+
+# (near, far): buildings switch to geometry with fewer segments beyond near
+# and to their bounding box beyond far; no LOD if None.
+LOD_DISTANCES = None
+
+# Parameters of TessellationPolicy, e.g. dict(quality='low') or dict(edge_length=4, max_angle=15),
+# to trade the vertex count of all buildings for quality; the default counts if None.
+TESSELLATION = None
+
+# How the convex pieces of the buildings collide, e.g. dict(mode='primitive', tolerance=0.5,
+# max_points=64): mode 'full' uses the hull of all vertices, 'reduced' the hull of the vertices
+# merged within tolerance, at most max_points, and 'primitive' a box, cylinder or capsule
+# if it fits within tolerance, otherwise the same as 'reduced'; the hulls of all vertices if None.
+COLLISION_HULL = None
+
+# If set to True, cylinders, elliptical prisms and boxes without holes or slices are generated
+# with NumPy in bulk instead of vertex by vertex by the shapes makers.
+VECTORIZED_MESHES = False
+
+# If set to True, the vertices of the buildings are stored as 16 bit integer positions and
+# normals without texcoords after flattening, which takes less than half the memory.
+COMPACT_VERTICES = False
+
+# If set to True, the buildings flattened by FLATTEN are colored by one palette texture
+# through their texcoords instead of a color state each, so they all share one render state.
+# The texture modulates the light after it is clamped, so sunlit faces keep their hue.
+PALETTE_COLORS = False
+
+# The path of a layout file made by `python layouts.py <path>`; if given, the city is built
+# from it instead of the hand-authored areas or PROCEDURAL_CITY, which still sizes the ground.
+LAYOUT = None
+
+# If set to True, the Bullet world only answers ray tests for the static city
+# and is not stepped while no dynamic bodies are attached with attach_dynamic().
+STATIC_WORLD = True
+
+# How clicks pick buildings: 'bullet' by Bullet ray tests, 'bvh' by Picker over the bounding
+# boxes of the building pieces, 'exact' by Picker refined by the triangles of the pieces.
+PICKING = 'bullet'
+
+# If set to True, the building under the mouse is picked by Picker and highlighted every frame.
+HOVER_PICKING = False
+
+# The size tier of the shadow map of the sun: 'off', 'low' (1024), 'medium' (2048),
+# 'high' (4096) or 'ultra' (8192).
+SHADOW_QUALITY = 'ultra'
+
+# If given, the shadow map covers the view of the camera up to this distance
+# instead of a fixed 200 x 200 area.
+SHADOW_DISTANCE = None
+
+# If set to True, the shadow map is rendered again only when the light, its film
+# or the city changes, instead of every frame.
+SHADOW_CACHED = False
+
+# If set to True, ambient occlusion and sunlight are baked into the vertex colors of the buildings,
+# which are then drawn without lights and shaders, and the sun casts no shadows.
+BAKED_LIGHTING = False
+
+# The number of the largest buildings used as occluders, hiding the buildings behind them
+# from the culling; 0 to disable. Each occluder costs culling time, so keep this small.
+OCCLUDERS = 0
+
 
 class VoronoiCity(ShowBase):
 
@@ -37,11 +139,30 @@ class VoronoiCity(ShowBase):
         self.world = BulletWorld()
         self.world.set_gravity(Vec3(0, 0, -9.81))
 
+        self.dynamic_bodies = set()
         self.debug = self.render.attach_new_node(BulletDebugNode('debug'))
         self.world.set_debug_node(self.debug.node())
 
-        self.scene = Scene()
-        self.scene.create_city()
+        generator = VoronoiCityGenerator(**PROCEDURAL_CITY) if PROCEDURAL_CITY else None
+        self.scene = Scene(generator, 'off' if BAKED_LIGHTING else SHADOW_QUALITY, CHUNKED_GROUND, SKY_MODE)
+        tessellation = TessellationPolicy(**TESSELLATION) if TESSELLATION else None
+        light_baker = LightBaker() if BAKED_LIGHTING else None
+
+        with profiler.span('create_city', 'startup'):
+            self.scene.create_city(
+                FLATTEN, INSTANCED_TREES, STREAMING, WORKERS, BAKE, SEED, LOD_DISTANCES, tessellation,
+                light_baker, OCCLUDERS, VECTORIZED_MESHES, COMPACT_VERTICES, LAYOUT, PALETTE_COLORS,
+                COLLISION_HULL)
+
+        self.shadows = ShadowController(self.scene.day_light, SHADOW_DISTANCE, SHADOW_CACHED)
+        self.shadow_version = 0
+
+        if SHADOW_QUALITY != 'off' and not BAKED_LIGHTING and (SHADOW_DISTANCE or SHADOW_CACHED):
+            self.shadows.start()
+
+        self.profiler_overlay = ProfilerOverlay(profiler)
+        if profiler.enabled:
+            profiler.start_render_timing()
 
         self.camera_root = NodePath('camera_root')
         self.camera_root.reparent_to(self.render)
@@ -54,12 +175,22 @@ class VoronoiCity(ShowBase):
         self.before_mouse_pos = None
         self.target = None
 
+        self.picker = Picker(exact=PICKING == 'exact')
+        self.picker_version = None
+        self.hovered = None
+        self.selection = []
+        self.selection_start = None
+
         self.accept('escape', sys.exit)
         self.accept('mouse1', self.mouse_click)
         self.accept('mouse1-up', self.mouse_release)
+        self.accept('shift-mouse1', self.start_selection)
+        self.accept('shift-mouse1-up', self.mouse_release)
         self.accept('d', self.toggle_debug)
         self.accept('i', self.get_target_info)
         self.accept('r', self.release_target)
+        self.accept('p', self.profiler_overlay.toggle)
+        self.accept('o', self.export_profile)
 
         if UNDER_CONSTRUCTION:
             self.accept('x', self.positioning, ['x', 1])
@@ -86,14 +217,37 @@ class VoronoiCity(ShowBase):
 
         return x, y
 
-    def click(self, mouse_pos):
-        print('clicked!')
+    def get_mouse_ray(self, mouse_pos):
         near_pos = Point3()
         far_pos = Point3()
         self.camLens.extrude(mouse_pos, near_pos, far_pos)
 
         from_pos = self.render.get_relative_point(self.cam, near_pos)
         to_pos = self.render.get_relative_point(self.cam, far_pos)
+        return from_pos, to_pos
+
+    def update_picker(self):
+        # rebuilt after buildings are moved or tiles are streamed in or out.
+        version = self.scene.streamer.version if self.scene.streamer else 0
+
+        if version != self.picker_version:
+            self.picker.build(self.scene.get_buildings())
+            self.picker_version = version
+
+    def pick(self, mouse_pos):
+        self.update_picker()
+        return self.picker.pick(*self.get_mouse_ray(mouse_pos))
+
+    def click(self, mouse_pos):
+        print('clicked!')
+
+        if PICKING != 'bullet':
+            if result := self.pick(mouse_pos):
+                print(f'set target: piece {result.piece} at {result.hit_pos}')
+                self.target = result.building
+            return
+
+        from_pos, to_pos = self.get_mouse_ray(mouse_pos)
 
         if (result := self.world.ray_test_closest(
                 from_pos, to_pos, BitMask32.bit(1))).has_hit():
@@ -106,6 +260,55 @@ class VoronoiCity(ShowBase):
                     print('set target')
                     self.target = NodePath(result.get_node())
 
+    def attach_dynamic(self, node):
+        self.world.attach(node)
+        self.dynamic_bodies.add(node)
+
+    def remove_dynamic(self, node):
+        self.world.remove(node)
+        self.dynamic_bodies.discard(node)
+
+    def sync_static_body(self, np):
+        # Bullet updates the bounding box of a moved static body only when stepped,
+        # so re-attach it to keep ray tests right.
+        if np.node() not in self.dynamic_bodies:
+            self.world.remove(np.node())
+            self.world.attach(np.node())
+
+    def highlight(self, building):
+        if building == self.hovered:
+            building.set_color_scale(1.3, 1.3, 1.3, 1)
+        elif building in self.selection:
+            building.set_color_scale(0.6, 0.6, 0.6, 1)
+        else:
+            building.clear_color_scale()
+
+    def hover(self, mouse_pos):
+        result = self.pick(mouse_pos)
+        building = result.building if result else None
+
+        if building != self.hovered:
+            before, self.hovered = self.hovered, building
+
+            for np in (before, building):
+                if np is not None:
+                    self.highlight(np)
+
+    def start_selection(self):
+        if self.mouseWatcherNode.has_mouse():
+            self.selection_start = Vec2(self.mouseWatcherNode.get_mouse())
+
+    def finish_selection(self, mouse_pos):
+        self.update_picker()
+        before, self.selection = self.selection, self.picker.select_rect(
+            self.cam, self.camLens, self.selection_start, mouse_pos)
+        self.selection_start = None
+
+        for building in before + self.selection:
+            self.highlight(building)
+
+        print(f'selected {len(self.selection)} buildings')
+
     def release_target(self):
         if self.target:
             self.target = None
@@ -137,6 +340,9 @@ class VoronoiCity(ShowBase):
             pos = self.target.get_pos() + pos
             hpr = self.target.get_hpr() + hpr
             self.target.set_pos_hpr(pos, hpr)
+            self.sync_static_body(self.target)
+            self.picker_version = None
+            self.shadows.invalidate()
 
     def toggle_debug(self):
         # self.toggle_wireframe()
@@ -145,11 +351,22 @@ class VoronoiCity(ShowBase):
         else:
             self.debug.hide()
 
+    def export_profile(self):
+        profiler.export_json('profile.json')
+        profiler.export_trace('profile_trace.json')
+        print('saved profile.json and profile_trace.json')
+
     def mouse_click(self):
         self.dragging = True
         self.dragging_start_time = globalClock.get_frame_time()
 
     def mouse_release(self):
+        if self.selection_start is not None:
+            if self.mouseWatcherNode.has_mouse():
+                self.finish_selection(Vec2(self.mouseWatcherNode.get_mouse()))
+            self.selection_start = None
+            return
+
         if globalClock.get_frame_time() - self.dragging_start_time < 0.2:
             self.clicked = True
 
@@ -175,12 +392,17 @@ class VoronoiCity(ShowBase):
 
         self.before_mouse_pos = Vec2(mouse_pos.xy)
 
+    @profiler.timed('frame', detailed=True)
     def update(self, task):
         dt = globalClock.get_dt()
 
-        if self.mouseWatcherNode.has_mouse():
+        # no mouse without a window, e.g. in benchmark.py
+        if self.mouseWatcherNode is not None and self.mouseWatcherNode.has_mouse():
             mouse_pos = self.mouseWatcherNode.get_mouse()
 
+            if HOVER_PICKING:
+                self.hover(mouse_pos)
+
             if self.clicked:
                 self.click(mouse_pos)
                 self.clicked = False
@@ -189,7 +411,17 @@ class VoronoiCity(ShowBase):
                 if globalClock.get_frame_time() - self.dragging_start_time >= 0.2:
                     self.rotate_camera(mouse_pos, dt)
 
-        self.world.do_physics(dt)
+        if self.scene.streamer and self.scene.streamer.version != self.shadow_version:
+            self.shadow_version = self.scene.streamer.version
+            self.shadows.invalidate()
+
+        if self.dynamic_bodies or not STATIC_WORLD:
+            with profiler.span('physics', 'frame', detailed=True):
+                self.world.do_physics(dt)
+        elif not self.debug.is_hidden():
+            # the debug node is only updated by stepping the world.
+            self.world.do_physics(0)
+
         return task.cont
 
 